@@ -4,7 +4,7 @@ from setuptools import setup, find_packages
 requires = [
 	"telepot",
 	"Flask",
-	"SQLAlchemy",
+	"SQLAlchemy>=1.4",
 ]
 
 setup(name = "poll-telegram-bot",
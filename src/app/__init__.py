@@ -1,5 +1,3 @@
-import sys
-
 if __name__ == "__main__":
 	from app.standalone_app import StandaloneApp
 	StandaloneApp().run()
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import threading
+import time
+from app.log import Log
+from app.metrics import Metrics
+
+_PRIORITIES = {
+	# Telegram clients show a spinner until a callback query is answered
+	"callback_query": 0,
+	# Users are waiting for these as they type
+	"inline_query": 1,
+	"chat": 2,
+}
+
+class _Item:
+	def __init__(self, priority, seq, flavor, msg, fn, on_overload):
+		self.priority = priority
+		self.seq = seq
+		self.flavor = flavor
+		self.msg = msg
+		self.fn = fn
+		self.on_overload = on_overload
+		self.enqueued_at = time.monotonic()
+		self.is_cancelled = False
+
+	def __lt__(self, other):
+		return (self.priority, self.seq) < (other.priority, other.seq)
+
+## Bounded priority queue in front of the handlers. Callback queries are served
+#  ahead of messages, updates that waited too long are dropped, and when the
+#  queue is full messages are shed to make room for callback queries. Rejected
+#  and stale updates are passed to @a on_overload, or to the one given to
+#  submit(), so that callback queries can still be answered
+class AdmissionQueue:
+	## Create the queue from the admission field in config.json, or return None
+	#  if admission control is not enabled
+	@staticmethod
+	def from_config(config, on_overload = None):
+		if not config:
+			return None
+		return AdmissionQueue(on_overload,
+				max_size = config.get("max_size", 100),
+				max_age = config.get("max_age", 30),
+				workers = config.get("workers", 1))
+
+	def __init__(self, on_overload = None, max_size = 100, max_age = 30, workers = 1):
+		self._on_overload = on_overload
+		self._max_size = max_size
+		self._max_age = max_age
+		self._workers = workers
+		self._heap = []
+		self._size = 0
+		self._seq = itertools.count()
+		self._cond = threading.Condition()
+		Metrics.gauge("admission_queue_depth", "Updates waiting to be handled",
+				fn = lambda: self._size)
+		Metrics.gauge("admission_queue_capacity", "Size of the admission queue",
+				fn = lambda: self._max_size)
+
+	def start(self):
+		for i in range(self._workers):
+			threading.Thread(target = self._run, name = f"admission-{i}",
+					daemon = True).start()
+
+	def submit(self, flavor, msg, fn, on_overload = None):
+		"""Queue @a fn to handle @a msg. Returns False if it was rejected.
+		@a on_overload, if any, is called instead of the one of the queue
+		should this update be dropped
+		"""
+		item = _Item(_PRIORITIES.get(flavor, len(_PRIORITIES)), next(self._seq),
+				flavor, msg, fn, on_overload or self._on_overload)
+		shed = None
+		with self._cond:
+			if self._size >= self._max_size:
+				shed = self._find_sheddable(item)
+				if shed is None:
+					self._count("admission_rejected_total", flavor)
+					is_rejected = True
+				else:
+					shed.is_cancelled = True
+					self._size -= 1
+					is_rejected = False
+			else:
+				is_rejected = False
+			if not is_rejected:
+				heapq.heappush(self._heap, item)
+				self._size += 1
+				self._count("admission_enqueued_total", flavor)
+				self._cond.notify()
+		if shed is not None:
+			self._count("admission_shed_total", shed.flavor)
+			self._overload(shed)
+		if is_rejected:
+			self._overload(item)
+		return not is_rejected
+
+	def _find_sheddable(self, item):
+		# The newest update with a lower priority than the incoming one
+		product = None
+		for other in self._heap:
+			if other.is_cancelled or other.priority <= item.priority:
+				continue
+			if product is None or (other.priority, other.seq) \
+					> (product.priority, product.seq):
+				product = other
+		return product
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._size:
+					self._cond.wait()
+				item = heapq.heappop(self._heap)
+				if item.is_cancelled:
+					continue
+				self._size -= 1
+			self._handle(item)
+
+	def _handle(self, item):
+		wait = time.monotonic() - item.enqueued_at
+		Metrics.histogram("admission_wait_seconds",
+				"Time spent in the admission queue", flavor = item.flavor) \
+				.observe(wait)
+		if self._get_age(item, wait) > self._max_age:
+			self._count("admission_stale_total", item.flavor)
+			self._overload(item)
+			return
+
+		begin = time.monotonic()
+		try:
+			item.fn()
+		except Exception as e:
+			Log.e("Failed while handling admitted update", e)
+		finally:
+			Metrics.histogram("admission_handle_seconds",
+					"Time spent handling an update", flavor = item.flavor) \
+					.observe(time.monotonic() - begin)
+			self._count("admission_handled_total", item.flavor)
+
+	def _get_age(self, item, wait):
+		if "date" in item.msg:
+			# Messages carry their send time, which also covers the time spent
+			# on Telegram's side before we got it
+			return max(wait, time.time() - item.msg["date"])
+		return wait
+
+	def _overload(self, item):
+		if item.on_overload is None:
+			return
+		try:
+			item.on_overload(item.flavor, item.msg)
+		except Exception as e:
+			Log.e("Failed while responding to overload", e)
+
+	def _count(self, name, flavor):
+		Metrics.counter(name, _HELPS[name], flavor = flavor).inc()
+
+_HELPS = {
+	"admission_enqueued_total": "Updates accepted into the queue",
+	"admission_rejected_total": "Updates rejected because the queue was full",
+	"admission_shed_total": "Queued updates dropped for a higher priority one",
+	"admission_stale_total": "Updates dropped for waiting longer than max_age",
+	"admission_handled_total": "Updates handled",
+}
@@ -0,0 +1,65 @@
+from app.config_loader import ConfigLoader
+from app.lazy import Lazy
+
+# Like in paw_app, the heavy dependencies are imported where they are first
+# needed, so that importing this module from the WSGI file stays cheap
+
+## What StandaloneApp and PawApp share: the components built from config.json,
+#  one of each per process, and the reply to shed updates
+class BaseApp:
+	def _on_overload(self, tenant, flavor, msg):
+		from app.message_handler import CallbackQueryHandler
+		# Messages are simply dropped, replying would only add to the load
+		if flavor == "callback_query":
+			CallbackQueryHandler.answer_overloaded(tenant.bot, msg)
+
+	@Lazy
+	def _Session(self):
+		import app.model as model
+		Session = model.create_session_class(echo = self._profiler.is_echo)
+		self._profiler.install(Session.kw["bind"])
+		return Session
+
+	@Lazy
+	def _is_toast_response(self):
+		return ConfigLoader.load_optional("callback_response") == "toast"
+
+	@Lazy
+	def _inline_query_cache_time(self):
+		return (ConfigLoader.load_optional("inline_query") or {}) \
+				.get("cache_time", 10)
+
+	@Lazy
+	def _profiler(self):
+		from app.profiler import Profiler
+		return Profiler.from_config(ConfigLoader.load_optional("profiling"))
+
+	@Lazy
+	def _recorder(self):
+		from app.update_recorder import UpdateRecorder
+		return UpdateRecorder.from_config(ConfigLoader.load_optional("recording"))
+
+	@Lazy
+	def _vote_buffer(self):
+		from app.vote_buffer import VoteBuffer
+		return VoteBuffer.from_config(self._Session,
+				ConfigLoader.load_optional("vote_buffer"))
+
+	@Lazy
+	def _tenants(self):
+		from app.tenant import Tenant
+		return Tenant.load_all(self._Session, vote_buffer = self._vote_buffer)
+
+	@Lazy
+	def _scheduler(self):
+		from app.message_handler import PollEventHandler
+		from app.poll_scheduler import PollScheduler
+		return PollScheduler.from_config(
+				[(t.poll_store, PollEventHandler(t.bot)) for t in self._tenants],
+				ConfigLoader.load_optional("scheduler"))
+
+	@Lazy
+	def _admission(self):
+		from app.admission import AdmissionQueue
+		return AdmissionQueue.from_config(
+				ConfigLoader.load_optional("admission"))
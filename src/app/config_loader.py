@@ -8,6 +8,27 @@ class ConfigLoader():
 	def load(identifier):
 		return ConfigLoader._ensure_config()[identifier]
 
+	## Like load(), but return @a default for fields that are not present
+	@staticmethod
+	def load_optional(identifier, default = None):
+		return ConfigLoader._ensure_config().get(identifier, default)
+
+	## Return the bots served by this process, each a dict with at least the id
+	#  and telegram_bot_token fields. Without the bots field, that's a single bot
+	#  with an empty id and the top level telegram_bot_token
+	@staticmethod
+	def load_bots():
+		bots = ConfigLoader.load_optional("bots")
+		if bots is None:
+			return [{
+				"id": "",
+				"telegram_bot_token": ConfigLoader.load("telegram_bot_token"),
+			}]
+		ids = [b["id"] for b in bots]
+		if len(set(ids)) != len(ids):
+			raise ValueError(f"Duplicated bot ids: {ids}")
+		return bots
+
 	@staticmethod
 	def _ensure_config():
 		if ConfigLoader._config is None:
@@ -0,0 +1,101 @@
+import telepot.api
+import urllib3
+from app.log import Log
+from app.metrics import Metrics
+
+# Pool used by getUpdates, kept apart so a pending long poll never holds a
+# connection needed to send a reply
+_LONG_POLL_POOL = "long_poll"
+_DEFAULT_POOL = "default"
+
+def _which_pool(req, **user_kw):
+	token, method, params, files = req
+	if files:
+		# Uploads get a one-time pool without timeout, see telepot.api
+		return None
+	return _LONG_POLL_POOL if method == "getUpdates" else _DEFAULT_POOL
+
+def _make_pool_manager(proxy_url, **kwargs):
+	if proxy_url:
+		return urllib3.ProxyManager(proxy_url = proxy_url, **kwargs)
+	else:
+		return urllib3.PoolManager(**kwargs)
+
+def _iter_connection_pools(manager):
+	for key in list(manager.pools.keys()):
+		pool = manager.pools.get(key)
+		if pool is not None:
+			yield pool
+
+def _count_idle(pool):
+	if pool.pool is None:
+		return 0
+	# The queue is padded with None up to maxsize
+	return sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+def _install_metrics(name, manager):
+	Metrics.gauge("http_pool_connections_total",
+			"HTTP connections opened, including reconnects",
+			fn = lambda: sum(p.num_connections
+					for p in _iter_connection_pools(manager)),
+			pool = name)
+	Metrics.gauge("http_pool_requests_total", "HTTP requests sent",
+			fn = lambda: sum(p.num_requests
+					for p in _iter_connection_pools(manager)),
+			pool = name)
+	Metrics.gauge("http_pool_idle_connections",
+			"Kept-alive connections ready for reuse",
+			fn = lambda: sum(_count_idle(p) for p in _iter_connection_pools(manager)),
+			pool = name)
+
+def configure_http_transport(config = None, workers = 1, defaults = None,
+		long_pollers = 1):
+	"""Replace the connection pools of telepot with keep-alive pools sized for
+	@a workers concurrent senders, one for outbound calls and one for long
+	polling by @a long_pollers bots. The pools are shared by every bot in the
+	process. Fields in @a config, the http field in config.json, take precedence
+	over @a defaults
+	"""
+	values = {
+		"proxy_url": None,
+		"pool_size": workers + 1,
+		"connect_timeout": 5,
+		"read_timeout": 30,
+		"retries": 3,
+	}
+	values.update(defaults or {})
+	values.update(config or {})
+
+	# Loading the CA certs is a large part of setting up a TLS connection, share
+	# one context so that it's only done once
+	ssl_context = urllib3.util.ssl_.create_urllib3_context()
+	ssl_context.load_default_certs()
+	common = dict(retries = values["retries"], ssl_context = ssl_context,
+			block = True)
+
+	send_pool = _make_pool_manager(values["proxy_url"], num_pools = 1,
+			maxsize = values["pool_size"],
+			timeout = urllib3.Timeout(connect = values["connect_timeout"],
+					read = values["read_timeout"]),
+			**common)
+	# telepot adds the getUpdates timeout to this, so it must be a number
+	long_poll_pool = _make_pool_manager(values["proxy_url"], num_pools = 1,
+			maxsize = long_pollers, timeout = values["connect_timeout"]
+					+ values["read_timeout"],
+			**common)
+	telepot.api._pools = {
+		_DEFAULT_POOL: send_pool,
+		_LONG_POLL_POOL: long_poll_pool,
+	}
+	onetime_kwargs = dict(num_pools = 1, maxsize = 1,
+			retries = values["retries"], timeout = 30)
+	if values["proxy_url"]:
+		telepot.api._onetime_pool_spec = (urllib3.ProxyManager,
+				dict(proxy_url = values["proxy_url"], **onetime_kwargs))
+	else:
+		telepot.api._onetime_pool_spec = (urllib3.PoolManager, onetime_kwargs)
+	telepot.api._which_pool = _which_pool
+
+	_install_metrics(_DEFAULT_POOL, send_pool)
+	_install_metrics(_LONG_POLL_POOL, long_poll_pool)
+	Log.i(f"HTTP transport: {values}")
@@ -1,56 +1,39 @@
-from datetime import datetime
-from sqlalchemy.orm import contains_eager
+import datetime
+import threading
+import weakref
 import telepot
 from telepot.exception import TelegramError
-from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
+from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton, \
+		InlineQueryResultArticle, InputTextMessageContent
 from app.lazy import Lazy
 from app.log import Log
-import app.model as model
-
-def _query_active_user_votes(session, chat_id, user_id):
-	return session.query(model.Poll) \
-			.filter(model.Poll.chat_id == chat_id) \
-			.filter(model.Poll.closed_at == None) \
-			.outerjoin(model.Poll.choices) \
-			.options(contains_eager(model.Poll.choices)) \
-			.outerjoin(model.PollChoice.votes) \
-			.options(contains_eager(model.Poll.choices,
-					model.PollChoice.votes)) \
-			.filter(model.PollVote.user_id == user_id) \
-			.order_by(model.Poll.poll_id, model.PollChoice.poll_choice_id) \
-			.all()
-
-def _query_active_polls(session, chat_id):
-	return session.query(model.Poll) \
-			.filter(model.Poll.chat_id == chat_id) \
-			.filter(model.Poll.closed_at == None) \
-			.outerjoin(model.Poll.choices) \
-			.options(contains_eager(model.Poll.choices)) \
-			.outerjoin(model.PollChoice.votes) \
-			.options(contains_eager(model.Poll.choices,
-					model.PollChoice.votes)) \
-			.order_by(model.Poll.poll_id, model.PollChoice.poll_choice_id, model.PollVote.poll_vote_id) \
-			.all()
-
-def _repr_poll(poll_m, is_sort_by_votes = False):
-	text = f"{poll_m.title}\n"
-	# [0] = choice number, [1] = choice model
-	choices = [(i + 1, c_m) for i, c_m in enumerate(poll_m.choices)]
+from app.poll_store import ConflictError, retry_on_conflict
+
+def _repr_poll(poll, is_sort_by_votes = False, is_result = False):
+	text = f"{poll.title}\n"
+	if poll.deadline_at is not None and not is_result:
+		text += f"Closes at {_repr_time(poll.deadline_at)}\n"
+	# [0] = choice number, [1] = choice
+	choices = [(i + 1, c) for i, c in enumerate(poll.choices)]
 	if is_sort_by_votes:
 		choices = sorted(choices, key = lambda c: (len(c[1].votes), -c[0]),
 				reverse = True)
 	choice_texts = []
 	for c in choices:
 		c_text = f"{c[0]}. {c[1].text} ({len(c[1].votes)})"
-		vote_texts = []
-		for v_m in c[1].votes:
-			vote_texts += [f"[{v_m.user_name}](tg://user?id={v_m.user_id})"]
-		if vote_texts:
-			c_text += "\n  " + ", ".join(vote_texts)
+		if c[1].votes:
+			c_text += "\n  " + ", ".join(v.mention for v in c[1].votes)
 		choice_texts += [c_text]
 	text += "\n\n".join(choice_texts)
 	return text
 
+def _repr_time(time):
+	return time.strftime("%Y-%m-%d %H:%M UTC")
+
+def _repr_result(poll):
+	return "Result:\n" + _repr_poll(poll, is_sort_by_votes = True,
+			is_result = True)
+
 def _make_poll_inline_keyboard(is_creator):
 	keyboard = [[
 		InlineKeyboardButton(text = "Vote", callback_data = "/vote"),
@@ -67,8 +50,17 @@ def _make_poll_inline_keyboard(is_creator):
 	return keyboard
 
 _RESPONSE_NEW_POLL = "To create a new poll, reply to this message with the poll title and choices\n\nExample:\nWhat to eat tonight?\nBurger\nPasta"
+_RESPONSE_BUSY = "The poll is busy right now, please try again"
 _RESPONSE_NEW_CHOICE = "To add a new choice, reply to this message with the choice in one line"
 
+# (label, seconds until the deadline, seconds before the deadline to remind)
+_DEADLINES = [
+	("1 hour", 60 * 60, None),
+	("1 day", 24 * 60 * 60, 60 * 60),
+	("3 days", 3 * 24 * 60 * 60, 6 * 60 * 60),
+	("1 week", 7 * 24 * 60 * 60, 24 * 60 * 60),
+]
+
 class _ResponseException(Exception):
 	def __init__(self, response, e = None):
 		self._response = response
@@ -84,6 +76,13 @@ class _ResponseException(Exception):
 	def __repr__(self):
 		return repr(self._e) if self._e is not None else self._response
 
+def _retry_on_conflict(fn):
+	try:
+		return retry_on_conflict(fn)
+	except ConflictError as e:
+		# Still conflicting after all the retries, e.g. in a storm of votes
+		raise _ResponseException(_RESPONSE_BUSY, e)
+
 ## Bot logic when it's called in a private chat
 class MessageHandler:
 	RESPONSE_EXCEPTION = "Unknown error"
@@ -95,14 +94,17 @@ class MessageHandler:
 	RESPONSE_ERROR_POLL_EXIST = "There can only be one active poll per chat, see /poll"
 	RESPONSE_ERROR_NEW_CHOICE_FORMAT = "Invalid input format"
 
-	def __init__(self, bot, msg, Session):
+	## @a bot_username is the username of @a bot, which may be appended to
+	#  commands in groups
+	def __init__(self, bot, msg, poll_store, bot_username = "yapbbot"):
 		self._bot = bot
 		self._msg = msg
-		self._Session = Session
+		self._poll_store = poll_store
+		self._bot_username = bot_username
 
 	def handle(self):
 		try:
-			self._do_handle()
+			_retry_on_conflict(self._do_handle)
 		except _ResponseException as e:
 			Log.e("Failed while handle", e)
 			self._bot.sendMessage(self._glance["chat_id"], e.response)
@@ -113,6 +115,10 @@ class MessageHandler:
 
 	def _do_handle(self):
 		Log.v(self._msg)
+		# Absent in channels
+		if "from" in self._msg:
+			self._poll_store.refresh_user(self._user["id"],
+					self._user["first_name"])
 		if self._glance["content_type"] == "text":
 			if self._msg["text"].startswith("/"):
 				self._handle_cmd(self._msg["text"])
@@ -121,23 +127,22 @@ class MessageHandler:
 		# Ignore non-text content (like new memeber msg)
 
 	def _handle_cmd(self, text):
-		if text.endswith("@yapbbot"):
-			text = text[:-8]
+		suffix = "@" + self._bot_username
+		if text.endswith(suffix):
+			text = text[:-len(suffix)]
 		if text == "/start" or text == "/poll":
 			self._handle_poll_cmd()
 
 	def _handle_poll_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._glance["chat_id"])
-			if not poll_ms:
-				# No active poll
-				self._handle_poll_cmd_sans_poll()
-				return
-
-			poll_m = poll_ms[0]
-			text = _repr_poll(poll_m)
-			keyboard = _make_poll_inline_keyboard(
-					poll_m.creator_user_id == self._user["id"])
+		poll = self._poll_store.get(self._glance["chat_id"])
+		if poll is None:
+			# No active poll
+			self._handle_poll_cmd_sans_poll()
+			return
+
+		text = _repr_poll(poll)
+		keyboard = _make_poll_inline_keyboard(
+				poll.creator_user_id == self._user["id"])
 		self._bot.sendMessage(self._glance["chat_id"], text,
 				parse_mode = "Markdown",
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
@@ -175,11 +180,11 @@ class MessageHandler:
 			raise _ResponseException(self.RESPONSE_ERROR_MISSING_CHOICES)
 
 		try:
-			with model.open_session(self._Session) as s:
-				if self._has_active_polls(s):
-					raise _ResponseException(self.RESPONSE_ERROR_POLL_EXIST)
+			if self._poll_store.get(self._glance["chat_id"]) is not None:
+				raise _ResponseException(self.RESPONSE_ERROR_POLL_EXIST)
 
-				self._persist_new_poll(s, title, choices);
+			self._poll_store.create_poll(self._glance["chat_id"], title, choices,
+					self._user["id"])
 			self._bot.sendMessage(self._glance["chat_id"],
 					self.RESPONSE_NEWPOLL_PERSISTED_F % title,
 					parse_mode = "Markdown")
@@ -195,32 +200,15 @@ class MessageHandler:
 			# Wrong format
 			raise _ResponseException(self.RESPONSE_ERROR_NEW_CHOICE_FORMAT)
 
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._glance["chat_id"])
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+		poll = self._poll_store.get(self._glance["chat_id"])
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
 
-			poll_m = poll_ms[0]
-			choice_m = model.PollChoice(text = choice, poll = poll_m)
-			s.add(choice_m)
+		self._poll_store.add_choice(poll, choice)
 		self._bot.sendMessage(self._glance["chat_id"],
 				self.RESPONSE_NEW_CHOICE_PERSISTED_F % choice,
 				parse_mode = "Markdown")
 
-	def _persist_new_poll(self, session, title, choices):
-		poll_m = model.Poll(title = title, chat_id = self._glance["chat_id"],
-				creator_user_id = self._user["id"])
-		choices_m = []
-		for c in choices:
-			choices_m += [model.PollChoice(text = c, poll = poll_m)]
-		session.add(poll_m)
-
-	def _has_active_polls(self, session):
-		return session.query(model.Poll) \
-				.filter(model.Poll.chat_id == self._glance["chat_id"]) \
-				.filter(model.Poll.closed_at == None) \
-				.count()
-
 	@property
 	def _user(self):
 		return self._msg["from"]
@@ -248,6 +236,9 @@ class CallbackQueryHandler:
 	RESPONSE_ALLOW_MULTI_VOTE = "Allow multiple votes per person? You *cannot* undo this action"
 	RESPONSE_ALLOW_MULTI_VOTE_PERSISTED = "Multiple votes allowed"
 	RESPONSE_CLOSE_POLL = "Close the poll? You *cannot* undo this action"
+	RESPONSE_DEADLINE = "When should the poll be closed automatically?"
+	RESPONSE_DEADLINE_PERSISTED_F = "The poll will be closed at %s"
+	RESPONSE_DEADLINE_REMOVED = "Deadline removed"
 	RESPONSE_CANCEL_OP = "Cancelled"
 	RESPONSE_ERROR_POLL_EXIST = "There can only be one active poll per chat, see /poll"
 	RESPONSE_ERROR_POLL_NOT_EXIST = "No active poll in this chat. Enter /start"
@@ -256,29 +247,52 @@ class CallbackQueryHandler:
 	RESPONSE_ERROR_IDENTICAL_VOTE = "You have picked this choice already, %s"
 	RESPONSE_ERROR_NOT_CREATOR = "Only the poll creator can do that"
 	RESPONSE_ERROR_RM_LAST_CHOICE = "Can't remove the last choice"
+	RESPONSE_OVERLOADED = "The bot is busy right now, please try again in a moment"
 
-	def __init__(self, bot, msg, Session):
+	## If @a is_toast_response is true, errors and personal confirmations are
+	#  shown as a notification on the answer of the callback query, instead of
+	#  sending or editing a message
+	def __init__(self, bot, msg, poll_store, is_toast_response = False):
 		self._bot = bot
 		self._msg = msg
-		self._Session = Session
+		self._poll_store = poll_store
+		self._is_toast_response = is_toast_response
+		self._is_answered = False
+
+	## Answer a callback query that won't be handled because the bot is
+	#  overloaded
+	@staticmethod
+	def answer_overloaded(bot, msg):
+		bot.answerCallbackQuery(msg["id"],
+				text = CallbackQueryHandler.RESPONSE_OVERLOADED)
 
 	def handle(self):
 		try:
-			self._do_handle()
+			# The poll may have been modified by a concurrent update
+			_retry_on_conflict(self._do_handle)
 		except _ResponseException as e:
 			Log.e("Failed while handle", e)
-			self._send_message(e.response, parse_mode = "Markdown")
+			if self._is_toast_response and not self._is_answered:
+				self._answer(e.response, show_alert = True)
+			else:
+				self._send_message(e.response, parse_mode = "Markdown")
 		except Exception as e:
 			Log.e("Failed while handle", e)
-			self._send_message(self.RESPONSE_EXCEPTION)
+			if self._is_toast_response and not self._is_answered:
+				self._answer(self.RESPONSE_EXCEPTION, show_alert = True)
+			else:
+				self._send_message(self.RESPONSE_EXCEPTION)
 		finally:
 			# After the user presses a callback button, Telegram clients will
 			# display a progress bar until you call answerCallbackQuery. It is,
 			# therefore, necessary to react by calling answerCallbackQuery even
 			# if no notification to the user is needed
-			self._bot.answerCallbackQuery(self._glance["query_id"])
+			if not self._is_answered:
+				self._answer()
 
 	def _do_handle(self):
+		# The user may be shown under an old name, e.g. before unvoting
+		self._poll_store.refresh_user(self._user["id"], self._user["first_name"])
 		if self._msg["data"].startswith("/"):
 			self._handle_cmd(self._glance["query_data"])
 
@@ -297,6 +311,10 @@ class CallbackQueryHandler:
 			self._handle_rm_choice_cmd()
 		elif text.startswith("/do-rm-choice-"):
 			self._handle_do_rm_choice_cmd(text)
+		elif text == "/deadline":
+			self._handle_deadline_cmd()
+		elif text.startswith("/do-deadline-"):
+			self._handle_do_deadline_cmd(text)
 		elif text == "/allow-multi-vote":
 			self._handle_allow_multi_vote_cmd()
 		elif text == "/do-allow-multi-vote":
@@ -313,10 +331,8 @@ class CallbackQueryHandler:
 			self._handle_cancel_op_cmd()
 
 	def _handle_new_poll_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_EXIST)
+		if self._poll_store.get(self._chat_id) is not None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_EXIST)
 		self._edit_message_text(_RESPONSE_NEW_POLL)
 
 	def _handle_close_poll_cmd(self):
@@ -331,40 +347,39 @@ class CallbackQueryHandler:
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
 	def _handle_do_close_poll_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			if poll_m.creator_user_id != self._user["id"]:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
-			text = "Result:\n" + _repr_poll(poll_m, is_sort_by_votes = True)
-			poll_m.closed_at = datetime.utcnow()
-		self._edit_message_text(text, parse_mode = "Markdown")
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		poll = self._poll_store.close_poll(poll)
+		self._edit_message_text(_repr_result(poll), parse_mode = "Markdown")
 
 	def _handle_edit_poll_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			keyboard = [[
-				InlineKeyboardButton(text = "Add a choice",
-						callback_data = "/new-choice"),
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		keyboard = [[
+			InlineKeyboardButton(text = "Add a choice",
+					callback_data = "/new-choice"),
+		]]
+		if poll.creator_user_id == self._user["id"]:
+			if len(poll.choices) > 1:
+				keyboard[0] += [
+					InlineKeyboardButton(text = "Remove a choice",
+							callback_data = "/rm-choice"),
+				]
+			if not poll.is_multiple_vote:
+				keyboard += [[
+					InlineKeyboardButton(text = "Allow multiple votes",
+							callback_data = "/allow-multi-vote"),
+				]]
+			keyboard += [[
+				InlineKeyboardButton(text = "Set deadline",
+						callback_data = "/deadline"),
 			]]
-			if poll_m.creator_user_id == self._user["id"]:
-				if len(poll_m.choices) > 1:
-					keyboard[0] += [
-						InlineKeyboardButton(text = "Remove a choice",
-								callback_data = "/rm-choice"),
-					]
-				if not poll_m.is_multiple_vote:
-					keyboard += [[
-						InlineKeyboardButton(text = "Allow multiple votes",
-								callback_data = "/allow-multi-vote"),
-					]]
 		self._edit_message_text(self.RESPONSE_EDIT_POLL,
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
@@ -372,20 +387,18 @@ class CallbackQueryHandler:
 		self._send_message(_RESPONSE_NEW_CHOICE)
 
 	def _handle_rm_choice_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			if poll_m.creator_user_id != self._user["id"]:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
-			btns = [InlineKeyboardButton(text = c_m.text,
-							callback_data = f"/do-rm-choice-{c_m.poll_choice_id}")
-					for c_m in poll_m.choices]
-			keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
-			keyboard += [[InlineKeyboardButton(text = "Cancel",
-					callback_data = "/cancel-op")]]
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		btns = [InlineKeyboardButton(text = c.text,
+						callback_data = f"/do-rm-choice-{c.poll_choice_id}")
+				for c in poll.choices]
+		keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
+		keyboard += [[InlineKeyboardButton(text = "Cancel",
+				callback_data = "/cancel-op")]]
 		self._edit_message_text(self.RESPONSE_RM_CHOICE, parse_mode = "Markdown",
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
@@ -397,22 +410,19 @@ class CallbackQueryHandler:
 			Log.e(f"Failed while parsing choice id: {text}")
 			raise
 
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			if poll_m.creator_user_id != self._user["id"]:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
-			if len(poll_m.choices) == 1:
-				raise _ResponseException(self.RESPONSE_ERROR_RM_LAST_CHOICE)
-			choice_m = next(filter(lambda c_m: c_m.poll_choice_id == choice_id,
-					poll_m.choices))
-			choice = choice_m.text
-			s.delete(choice_m)
-
-		self._edit_message_text(self.RESPONSE_RM_CHOICE_PERSISTED_F % choice,
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		if len(poll.choices) == 1:
+			raise _ResponseException(self.RESPONSE_ERROR_RM_LAST_CHOICE)
+		choice = next(filter(lambda c: c.poll_choice_id == choice_id,
+				poll.choices))
+		self._poll_store.remove_choice(poll, choice_id)
+
+		self._edit_message_text(self.RESPONSE_RM_CHOICE_PERSISTED_F % choice.text,
 				parse_mode = "Markdown")
 
 	def _handle_allow_multi_vote_cmd(self):
@@ -427,28 +437,72 @@ class CallbackQueryHandler:
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
 	def _handle_do_allow_multi_vote_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			if poll_m.creator_user_id != self._user["id"]:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
-			poll_m.is_multiple_vote = True
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		self._poll_store.allow_multi_vote(poll)
 		self._edit_message_text(self.RESPONSE_ALLOW_MULTI_VOTE_PERSISTED)
 
+	def _handle_deadline_cmd(self):
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		btns = [InlineKeyboardButton(text = d[0],
+						callback_data = f"/do-deadline-{i}")
+				for i, d in enumerate(_DEADLINES)]
+		keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
+		if poll.deadline_at is not None:
+			keyboard += [[InlineKeyboardButton(text = "No deadline",
+					callback_data = "/do-deadline-none")]]
+		keyboard += [[InlineKeyboardButton(text = "Cancel",
+				callback_data = "/cancel-op")]]
+		self._edit_message_text(self.RESPONSE_DEADLINE,
+				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
+
+	def _handle_do_deadline_cmd(self, text):
+		# /do-deadline-{index in _DEADLINES or none}
+		arg = text[13:]
+		try:
+			deadline = None if arg == "none" else _DEADLINES[int(arg)]
+		except Exception:
+			Log.e(f"Failed while parsing deadline: {text}")
+			raise
+
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		if poll.creator_user_id != self._user["id"]:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_CREATOR)
+		if deadline is None:
+			self._poll_store.set_deadline(poll, None)
+			self._edit_message_text(self.RESPONSE_DEADLINE_REMOVED)
+			return
+
+		_, duration, remind_before = deadline
+		deadline_at = datetime.datetime.utcnow() \
+				+ datetime.timedelta(seconds = duration)
+		remind_at = deadline_at - datetime.timedelta(seconds = remind_before) \
+				if remind_before is not None else None
+		self._poll_store.set_deadline(poll, deadline_at, remind_at)
+		self._edit_message_text(self.RESPONSE_DEADLINE_PERSISTED_F
+				% _repr_time(deadline_at))
+
 	def _handle_vote_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			btns = [InlineKeyboardButton(text = c_m.text,
-							callback_data = f"/do-vote-{c_m.poll_choice_id}")
-					for c_m in poll_m.choices]
-			keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		btns = [InlineKeyboardButton(text = c.text,
+						callback_data = f"/do-vote-{c.poll_choice_id}")
+				for c in poll.choices]
+		keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
 		self._edit_message_text(self.RESPONSE_VOTE,
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
@@ -460,63 +514,52 @@ class CallbackQueryHandler:
 			Log.e(f"Failed while parsing choice id: {text}")
 			raise
 
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			user_id = self._user["id"]
-			for c_m in poll_m.choices:
-				if c_m.poll_choice_id == vote:
-					choice_m = c_m
-					break
-			# We don't need a fallback val for choice_m -- it'll raise when we
-			# access it anyway
-
-			if not poll_m.is_multiple_vote:
-				# Make sure user hasn't voted yet
-				for c_m in poll_m.choices:
-					if any(user_id == v_m.user_id for v_m in c_m.votes):
-						raise _ResponseException(
-								self.RESPONSE_ERROR_MULTIPLE_VOTE
-										% f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-			else:
-				# Make sure user hasn't voted for this choice yet
-				if any(user_id == v_m.user_id for v_m in choice_m.votes):
-					raise _ResponseException(self.RESPONSE_ERROR_IDENTICAL_VOTE
-							% f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-
-			vote_m = model.PollVote(user_id = user_id,
-					user_name = self._user["first_name"],
-					choice = choice_m)
-			s.add(vote_m)
-
-			text = self.RESPONSE_VOTED % (
-					f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-			announce_text = self.RESPONSE_VOTE_ANNOUNCE % (
-					f"[{self._user['first_name']}](tg://user?id={self._user['id']})",
-					choice_m.text)
-			poll_text = _repr_poll(poll_m)
-			poll_keyboard = _make_poll_inline_keyboard(
-					poll_m.creator_user_id == self._user["id"])
-		self._edit_message_text(text, parse_mode = "Markdown")
+		poll = self._poll_store.get(self._chat_id)
+		if poll is None:
+			raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
+
+		user_id = self._user["id"]
+		choice = poll.find_choice(vote)
+		if choice is None:
+			raise KeyError(f"Unknown choice id: {vote}")
+
+		if not poll.is_multiple_vote:
+			# Make sure user hasn't voted yet
+			for c in poll.choices:
+				if user_id in c.voters:
+					raise _ResponseException(
+							self.RESPONSE_ERROR_MULTIPLE_VOTE % self._reply_mention)
+		else:
+			# Make sure user hasn't voted for this choice yet
+			if user_id in choice.voters:
+				raise _ResponseException(self.RESPONSE_ERROR_IDENTICAL_VOTE
+						% self._reply_mention)
+
+		poll = self._poll_store.vote(poll, vote, user_id,
+				self._user["first_name"])
+
+		text = self.RESPONSE_VOTED % self._reply_mention
+		announce_text = self.RESPONSE_VOTE_ANNOUNCE % (self._mention,
+				choice.text)
+		poll_text = _repr_poll(poll)
+		poll_keyboard = _make_poll_inline_keyboard(
+				poll.creator_user_id == self._user["id"])
+		self._confirm(text)
 		self._send_message(announce_text, parse_mode = "Markdown")
 		self._send_message(poll_text, parse_mode = "Markdown",
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = poll_keyboard))
 
 	def _handle_unvote_cmd(self):
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_user_votes(s, self._chat_id, self._user["id"])
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_VOTED
-						% f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-
-			poll_m = poll_ms[0]
-			btns = [InlineKeyboardButton(text = c_m.text,
-							callback_data = f"/do-unvote-{c_m.poll_choice_id}")
-					for c_m in poll_m.choices]
-			keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
+		choices = self._get_user_voted_choices(
+				self._poll_store.get(self._chat_id))
+		if not choices:
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_VOTED
+					% self._reply_mention)
+
+		btns = [InlineKeyboardButton(text = c.text,
+						callback_data = f"/do-unvote-{c.poll_choice_id}")
+				for c in choices]
+		keyboard = [btns[i:i + 2] for i in range(0, len(btns), 2)]
 		self._edit_message_text(self.RESPONSE_UNVOTE,
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = keyboard))
 
@@ -528,46 +571,24 @@ class CallbackQueryHandler:
 			Log.e(f"Failed while parsing choice id: {text}")
 			raise
 
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_user_votes(s, self._chat_id, self._user["id"])
-			if not poll_ms:
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_VOTED
-						% f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-
-			poll_m = poll_ms[0]
-			for c_m in poll_m.choices:
-				if c_m.poll_choice_id == vote:
-					for v_m in c_m.votes:
-						if v_m.user_id == self._user["id"]:
-							vote_m = v_m
-							break
-			try:
-				choice_text = vote_m.choice.text
-				s.delete(vote_m)
-			except NameError:
-				# User hasn't voted this option?
-				raise _ResponseException(self.RESPONSE_ERROR_NOT_VOTED
-						% f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-
-			text = self.RESPONSE_UNVOTED % (
-					f"[{self._user['first_name']}](tg://user?id={self._user['id']})")
-			announce_text = self.RESPONSE_UNVOTE_ANNOUNCE % (
-					f"[{self._user['first_name']}](tg://user?id={self._user['id']})",
-					choice_text)
-		self._edit_message_text(text, parse_mode = "Markdown")
+		poll = self._poll_store.get(self._chat_id)
+		choice = next((c for c in self._get_user_voted_choices(poll)
+				if c.poll_choice_id == vote), None)
+		if choice is None:
+			# User hasn't voted this option?
+			raise _ResponseException(self.RESPONSE_ERROR_NOT_VOTED
+					% self._reply_mention)
+		poll = self._poll_store.unvote(poll, vote, self._user["id"])
+
+		text = self.RESPONSE_UNVOTED % self._reply_mention
+		announce_text = self.RESPONSE_UNVOTE_ANNOUNCE % (self._mention,
+				choice.text)
+		self._confirm(text)
 		self._send_message(announce_text, parse_mode = "Markdown")
 
-		# Start a new session to make the delete effective
-		with model.open_session(self._Session) as s:
-			poll_ms = _query_active_polls(s, self._chat_id)
-			if not poll_ms:
-				# ???
-				raise _ResponseException(self.RESPONSE_ERROR_POLL_NOT_EXIST)
-
-			poll_m = poll_ms[0]
-			poll_text = _repr_poll(poll_m)
-			poll_keyboard = _make_poll_inline_keyboard(
-					poll_m.creator_user_id == self._user["id"])
+		poll_text = _repr_poll(poll)
+		poll_keyboard = _make_poll_inline_keyboard(
+				poll.creator_user_id == self._user["id"])
 		self._send_message(poll_text, parse_mode = "Markdown",
 				reply_markup = InlineKeyboardMarkup(inline_keyboard = poll_keyboard))
 
@@ -577,6 +598,25 @@ class CallbackQueryHandler:
 			# Can fail if the message is too old
 			self._edit_message_text(self.RESPONSE_CANCEL_OP)
 
+	def _get_user_voted_choices(self, poll):
+		"""Return the choices in @a poll voted by the current user"""
+		if poll is None:
+			return []
+		return [c for c in poll.choices if self._user["id"] in c.voters]
+
+	def _confirm(self, text):
+		"""Tell the user the result of their own action"""
+		if self._is_toast_response:
+			self._answer(text)
+		else:
+			self._edit_message_text(text, parse_mode = "Markdown")
+
+	def _answer(self, text = None, **kwargs):
+		self._is_answered = True
+		if text is not None:
+			kwargs["text"] = text
+		self._bot.answerCallbackQuery(self._glance["query_id"], **kwargs)
+
 	def _send_message(self, *args, **kwargs):
 		if "message" not in self._msg:
 			# Can't send a msg without this
@@ -598,6 +638,16 @@ class CallbackQueryHandler:
 	def _user(self):
 		return self._msg["from"]
 
+	@property
+	def _mention(self):
+		return f"[{self._user['first_name']}](tg://user?id={self._user['id']})"
+
+	@property
+	def _reply_mention(self):
+		# Notifications are plain text
+		return self._user["first_name"] if self._is_toast_response \
+				else self._mention
+
 	@property
 	def _chat_id(self):
 		return self._msg["message"]["chat"]["id"]
@@ -611,3 +661,78 @@ class CallbackQueryHandler:
 			"from_id": from_id,
 			"query_data": query_data,
 		}
+
+## Inline query results of the poll snapshots, rendered once per snapshot. The
+#  snapshots are never modified, but their voters are renamed in place, see
+#  ActivePollStore.refresh_user(). An entry is thus kept along with the mentions
+#  it was rendered with, and valid for as long as they match
+_inline_results = weakref.WeakKeyDictionary()
+_inline_results_lock = threading.Lock()
+
+def _get_inline_result(poll):
+	# Renaming replaces the mention, comparing them is mostly identity checks
+	mentions = [v.mention for c in poll.choices for v in c.voters.values()]
+	with _inline_results_lock:
+		entry = _inline_results.get(poll)
+	if entry is not None and entry[0] == mentions:
+		return entry[1]
+	vote_count = len(mentions)
+	product = InlineQueryResultArticle(id = str(poll.poll_id),
+			title = poll.title,
+			description = f"{len(poll.choices)} choices, {vote_count} votes",
+			input_message_content = InputTextMessageContent(
+					message_text = _repr_poll(poll), parse_mode = "Markdown"))
+	with _inline_results_lock:
+		_inline_results[poll] = (mentions, product)
+	return product
+
+## Bot logic when it's called inline, i.e. @yapbbot in any chat. Answers with the
+#  caller's active polls, optionally filtered by the query text
+class InlineQueryHandler:
+	## @a cache_time is how long in seconds Telegram may cache the results
+	def __init__(self, bot, msg, poll_store, cache_time = 10):
+		self._bot = bot
+		self._msg = msg
+		self._poll_store = poll_store
+		self._cache_time = cache_time
+
+	def handle(self):
+		try:
+			self._do_handle()
+		except Exception as e:
+			Log.e("Failed while handle", e)
+
+	def _do_handle(self):
+		query_id, from_id, query = telepot.glance(self._msg,
+				flavor = "inline_query")
+		query = query.strip().lower()
+		results = [_get_inline_result(p)
+				for p in self._poll_store.get_by_creator(from_id)
+				if query in p.title.lower()]
+		# Telegram takes at most 50 results per answer
+		results = results[:50]
+		# The results depend on who's asking
+		self._bot.answerInlineQuery(query_id, results,
+				cache_time = self._cache_time, is_personal = True)
+
+## Bot logic for the scheduled events of a poll, see PollScheduler
+class PollEventHandler:
+	RESPONSE_CLOSED = "The poll has reached its deadline"
+	RESPONSE_REMINDER_F = "Reminder: *%s* will be closed at %s, see /poll"
+
+	def __init__(self, bot):
+		self._bot = bot
+
+	def on_closed(self, poll):
+		self._send(poll, self.RESPONSE_CLOSED + "\n\n" + _repr_result(poll))
+
+	def on_reminder(self, poll):
+		self._send(poll, self.RESPONSE_REMINDER_F % (poll.title,
+				_repr_time(poll.deadline_at)))
+
+	def _send(self, poll, text):
+		try:
+			self._bot.sendMessage(poll.chat_id, text, parse_mode = "Markdown")
+		except Exception as e:
+			# e.g. the bot has been removed from the chat
+			Log.e(f"Failed while sending to chat {poll.chat_id}", e)
@@ -0,0 +1,99 @@
+import bisect
+import threading
+
+class _Counter:
+	def __init__(self):
+		self._value = 0
+		self._lock = threading.Lock()
+
+	def inc(self, n = 1):
+		with self._lock:
+			self._value += n
+
+	def samples(self, name, labels):
+		return [(name, labels, self._value)]
+
+class _Gauge:
+	def __init__(self, fn = None):
+		self._value = 0
+		self._fn = fn
+
+	def set(self, value):
+		self._value = value
+
+	def samples(self, name, labels):
+		return [(name, labels, self._fn() if self._fn else self._value)]
+
+class _Histogram:
+	def __init__(self, buckets):
+		self._buckets = sorted(buckets)
+		self._counts = [0] * (len(self._buckets) + 1)
+		self._sum = 0
+		self._lock = threading.Lock()
+
+	def observe(self, value):
+		with self._lock:
+			self._counts[bisect.bisect_left(self._buckets, value)] += 1
+			self._sum += value
+
+	def samples(self, name, labels):
+		with self._lock:
+			counts = list(self._counts)
+			total = self._sum
+		product = []
+		cumulative = 0
+		for bound, count in zip(self._buckets + [float("inf")], counts):
+			cumulative += count
+			le = "+Inf" if bound == float("inf") else repr(bound)
+			product += [(name + "_bucket", dict(labels, le = le), cumulative)]
+		product += [(name + "_count", labels, cumulative),
+				(name + "_sum", labels, total)]
+		return product
+
+## Process wide registry of counters, gauges and histograms, rendered in the
+#  Prometheus text format. Asking for the same name and labels twice returns the
+#  same metric
+class Metrics():
+	DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+	@staticmethod
+	def counter(name, help = "", **labels):
+		return Metrics._get(name, "counter", help, labels, _Counter)
+
+	## @a fn, if given, is called to read the value at render time
+	@staticmethod
+	def gauge(name, help = "", fn = None, **labels):
+		return Metrics._get(name, "gauge", help, labels, lambda: _Gauge(fn))
+
+	@staticmethod
+	def histogram(name, help = "", buckets = None, **labels):
+		return Metrics._get(name, "histogram", help, labels,
+				lambda: _Histogram(buckets or Metrics.DEFAULT_BUCKETS))
+
+	@staticmethod
+	def render():
+		with Metrics._lock:
+			items = sorted(Metrics._metrics.items())
+		lines = []
+		last_name = None
+		for (name, label_items), (kind, help, metric) in items:
+			if name != last_name:
+				lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+				last_name = name
+			for sample, labels, value in metric.samples(name, dict(label_items)):
+				label_text = ",".join(f"{k}=\"{v}\"" for k, v in labels.items())
+				if label_text:
+					sample += "{" + label_text + "}"
+				lines += [f"{sample} {value}"]
+		return "\n".join(lines) + "\n"
+
+	@staticmethod
+	def _get(name, kind, help, labels, factory):
+		key = (name, tuple(sorted(labels.items())))
+		with Metrics._lock:
+			if key not in Metrics._metrics:
+				Metrics._metrics[key] = (kind, help, factory())
+			return Metrics._metrics[key][2]
+
+	_metrics = {}
+	_lock = threading.Lock()
@@ -1,7 +1,9 @@
 from contextlib import contextmanager
 import datetime
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, ForeignKey, UniqueConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, String, ForeignKey, UniqueConstraint, create_engine, exists, literal, or_, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -10,6 +12,10 @@ Base = declarative_base()
 class HandledUpdate(Base):
 	__tablename__ = "handled_update"
 	_id = Column(Integer, primary_key = True)
+	# The bot that received the update, see Poll.bot_id. Each bot numbers its
+	# own updates
+	bot_id = Column(String, nullable = False, default = "",
+			server_default = "")
 	update_id = Column(Integer, index = True)
 	created_at = Column(DateTime, nullable = False,
 			default = datetime.datetime.utcnow)
@@ -17,6 +23,11 @@ class HandledUpdate(Base):
 class Poll(Base):
 	__tablename__ = "poll"
 	poll_id = Column(Integer, primary_key = True)
+	# The bot serving the poll when several share a process, see
+	# ConfigLoader.load_bots(). Chat ids are global, but two bots in the same
+	# group can each have their own active poll
+	bot_id = Column(String, nullable = False, default = "",
+			server_default = "")
 	title = Column(String, nullable = False)
 	# If string starts with @, it's a public channel id and otherwise assume it
 	# is a long value
@@ -26,10 +37,35 @@ class Poll(Base):
 			default = datetime.datetime.utcnow)
 	closed_at = Column(DateTime)
 	is_multiple_vote = Column(Boolean, nullable = False, default = False)
+	# Bumped on every change to the poll and its choices, so that concurrent
+	# writers can detect each other. Votes leave it alone and are checked by
+	# the DB instead, see insert_vote()
+	version = Column(Integer, nullable = False, default = 0,
+			server_default = "0")
+	# Close the poll automatically at this time
+	deadline_at = Column(DateTime)
+	# Remind the chat about the poll at this time, unless reminded_at is set
+	remind_at = Column(DateTime)
+	reminded_at = Column(DateTime)
 
 	choices = relationship("PollChoice", backref = "poll",
 			cascade = "all, delete-orphan", passive_deletes = True)
 
+	__table_args__ = (
+		# At most one active poll per chat and bot
+		Index("ix_poll_active_chat_id", bot_id, chat_id, unique = True,
+				sqlite_where = text("closed_at IS NULL")),
+		# For inline queries
+		Index("ix_poll_active_creator_user_id", bot_id, creator_user_id,
+				sqlite_where = text("closed_at IS NULL")),
+		# For the scheduler
+		Index("ix_poll_active_deadline_at", deadline_at,
+				sqlite_where = text("closed_at IS NULL AND deadline_at IS NOT NULL")),
+		Index("ix_poll_active_remind_at", remind_at,
+				sqlite_where = text("closed_at IS NULL AND remind_at IS NOT NULL "
+						"AND reminded_at IS NULL")),
+	)
+
 class PollChoice(Base):
 	__tablename__ = "poll_choice"
 	poll_choice_id = Column(Integer, primary_key = True)
@@ -40,18 +76,78 @@ class PollChoice(Base):
 	votes = relationship("PollVote", backref = "choice",
 			cascade = "all, delete-orphan", passive_deletes = True)
 
+class User(Base):
+	__tablename__ = "user"
+	# Telegram user id
+	user_id = Column(Integer, primary_key = True, autoincrement = False)
+	# The latest first name seen for this user
+	name = Column(String, nullable = False)
+	updated_at = Column(DateTime, nullable = False,
+			default = datetime.datetime.utcnow)
+
 class PollVote(Base):
 	__tablename__ = "poll_vote"
 	poll_vote_id = Column(Integer, primary_key = True)
 	poll_choice_id = Column(Integer, ForeignKey(PollChoice.poll_choice_id,
 			ondelete = "CASCADE"), nullable = False)
-	user_id = Column(Integer, nullable = False)
-	user_name = Column(String, nullable = False)
+	user_id = Column(Integer, ForeignKey(User.user_id), nullable = False)
 	created_at = Column(DateTime, nullable = False,
 			default = datetime.datetime.utcnow)
 
+	user = relationship(User)
+
 	UniqueConstraint(poll_choice_id, user_id)
 
+def insert_vote(session, poll_choice_id, user_id, created_at = None):
+	"""Add a vote made at @a created_at, unless the poll was closed by then, the
+	choice is gone or, for a single vote poll, the user has voted already.
+	Returns whether it was added
+	"""
+	created_at = created_at or datetime.datetime.utcnow()
+	vote = PollVote.__table__
+	choice = PollChoice.__table__
+	poll = Poll.__table__
+	other_choice = choice.alias()
+	has_voted = exists(select(literal(1))
+			.select_from(vote.join(other_choice,
+					vote.c.poll_choice_id == other_choice.c.poll_choice_id))
+			.where(other_choice.c.poll_id == poll.c.poll_id)
+			.where(vote.c.user_id == user_id))
+	stmt = insert(vote).from_select(
+			["poll_choice_id", "user_id", "created_at"],
+			select(choice.c.poll_choice_id, literal(user_id), literal(created_at))
+			.select_from(choice.join(poll,
+					choice.c.poll_id == poll.c.poll_id))
+			.where(choice.c.poll_choice_id == poll_choice_id)
+			.where(or_(poll.c.closed_at == None, poll.c.closed_at > created_at))
+			.where(or_(poll.c.is_multiple_vote, ~has_voted)))
+	try:
+		# Voting twice for the same choice is caught by the unique constraint
+		with session.begin_nested():
+			return session.execute(stmt).rowcount == 1
+	except IntegrityError:
+		return False
+
+def upsert_user(session, user_id, name):
+	"""Insert or rename a User, it's a no-op if the name is the same"""
+	stmt = insert(User).values(user_id = user_id, name = name,
+			updated_at = datetime.datetime.utcnow())
+	session.execute(stmt.on_conflict_do_update(
+			index_elements = [User.user_id],
+			set_ = {"name": stmt.excluded.name,
+					"updated_at": stmt.excluded.updated_at},
+			where = User.name != stmt.excluded.name))
+
+DEFAULT_DB_URL = "sqlite:///poll.db"
+
+def create_session_class(db_url = DEFAULT_DB_URL, **kwargs):
+	"""Create the Session class bound to a new engine. The engine owns the
+	connection pool and the compiled statement cache, so it should be created
+	once per process and shared by every update
+	"""
+	engine = create_engine(db_url, **kwargs)
+	return sessionmaker(bind = engine)
+
 @contextmanager
 def open_session(Session):
 	"""Provide a transactional scope around a series of operations."""
@@ -1,83 +1,159 @@
-from flask import Flask, request
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import telepot
-import urllib3
+from app.base_app import BaseApp
 from app.config_loader import ConfigLoader
 from app.log import Log
-from app.message_handler import CallbackQueryHandler, MessageHandler
-import app.model as model
 
-flask_app = None
+# Heavy dependencies (Flask, SQLAlchemy, telepot and the handlers) are imported
+# where they are first needed, so importing this module from the WSGI file stays
+# cheap. run() pulls them all in through warm_up() before the webhook goes live
 
-class PawApp():
-	TELEGRAM_TOKEN = ConfigLoader.load("telegram_bot_token")
+flask_app = None
 
+## Serves every bot in config.json, see ConfigLoader.load_bots(), each on its own
+#  webhook route: /<webhook_secret> for the bot with an empty id and
+#  /<webhook_secret>/<id> for the others
+class PawApp(BaseApp):
 	def __init__(self):
 		Log.i("Initializing PAW app")
 		self._init_paw_telepot()
-		self._bot = telepot.Bot(self.TELEGRAM_TOKEN)
 
 	def run(self):
-		url = ConfigLoader.load("paw_app")["url"]
-		secret = ConfigLoader.load("paw_app")["webhook_secret"]
+		from flask import Flask
+		config = ConfigLoader.load("paw_app")
+		url = config["url"]
+		secret = config["webhook_secret"]
 
 		app = Flask(__name__)
-		def _webhook_view():
-			return self._on_webhook()
-		app.add_url_rule("/%s" % secret, view_func = _webhook_view,
-				methods = ["POST"])
+		for tenant in self._tenants:
+			self._add_webhook_route(app, tenant, secret)
+		def _metrics_view():
+			from app.metrics import Metrics
+			return Metrics.render(), 200, {"Content-Type": "text/plain"}
+		app.add_url_rule("/%s/metrics" % secret, view_func = _metrics_view,
+				methods = ["GET"])
 
 		global flask_app
 		flask_app = app
 
-		self._bot.setWebhook("%s/%s" % (url, secret), max_connections = 1)
+		if self._vote_buffer is not None:
+			# There's no background thread here, pending votes are flushed on
+			# the following updates instead
+			self._vote_buffer.recover()
+		self.warm_up()
+		try:
+			self._scheduler.load()
+		except Exception as e:
+			# It's retried on the following updates
+			Log.w("Failed while loading the schedule", e)
+		if self._admission is not None:
+			# Needs threads to be enabled for the web app
+			self._admission.start()
+		if config.get("register_webhook", True):
+			for tenant in self._tenants:
+				tenant.bot.setWebhook("%s/%s" % (url,
+						_get_webhook_path(tenant, secret)), max_connections = 1)
+
+	def warm_up(self):
+		"""Import the handlers and prepare the engine and its statement cache,
+		so the first webhook after a worker restart doesn't pay for them
+		"""
+		import datetime
+		import app.message_handler
+		import app.model as model
+		Log.i("Warming up")
+		try:
+			for tenant in self._tenants:
+				tenant.poll_store.warm_up()
+			with model.open_session(self._Session) as s:
+				_query_handled_update_count(s, "", 0, datetime.datetime.utcnow())
+		except Exception as e:
+			# Not fatal, the first update will just be slower
+			Log.w("Failed while warm_up", e)
 
 	def _init_paw_telepot(self):
-		# You can leave this bit out if you're using a paid PythonAnywhere
-		# account
-		proxy_url = "http://proxy.server:3128"
-		telepot.api._pools = {
-			"default": urllib3.ProxyManager(proxy_url = proxy_url, num_pools = 3,
-					maxsize = 10, retries = False, timeout = 30),
-		}
-		telepot.api._onetime_pool_spec = (urllib3.ProxyManager,
-				dict(proxy_url = proxy_url, num_pools = 1, maxsize = 1,
-						retries = False, timeout = 30))
-		# end of the stuff that's only needed for free accounts
-
-	def _on_webhook(self):
+		from app.http_transport import configure_http_transport
+		workers = (ConfigLoader.load_optional("admission") or {}) \
+				.get("workers", 1)
+		# Free PythonAnywhere accounts can only reach Telegram through their
+		# proxy. With a paid account, you can set http.proxy_url to null in
+		# config.json
+		configure_http_transport(ConfigLoader.load_optional("http"),
+				workers = workers, defaults = {
+					"proxy_url": "http://proxy.server:3128",
+					"retries": False,
+				})
+
+	def _add_webhook_route(self, app, tenant, secret):
+		def _webhook_view():
+			return self._on_webhook(tenant)
+		# Endpoints are named after the view by default, which is the same for
+		# every bot
+		app.add_url_rule("/" + _get_webhook_path(tenant, secret),
+				endpoint = f"webhook_{tenant.bot_id}", view_func = _webhook_view,
+				methods = ["POST"])
+
+	def _on_webhook(self, tenant):
+		import functools
+		from flask import request
 		update = request.get_json()
-		self._handle_update(update)
+		if self._recorder is not None:
+			# Before admission, so that shed updates are recorded too
+			self._recorder.record(update, bot_id = tenant.bot_id)
+		if self._admission is None:
+			self._handle_update(tenant, update)
+		else:
+			flavor, msg = _glance_update(update)
+			self._admission.submit(flavor, msg,
+					lambda: self._handle_update(tenant, update),
+					on_overload = functools.partial(self._on_overload, tenant))
 		return "OK"
 
-	def _handle_update(self, update):
+	def _handle_update(self, tenant, update):
+		from app.profiler import make_update_tag
+		flavor, msg = _glance_update(update)
+		with self._profiler.profile(make_update_tag(flavor, msg)):
+			self._do_handle_update(tenant, update)
+
+	def _do_handle_update(self, tenant, update):
+		from app.message_handler import CallbackQueryHandler, \
+				InlineQueryHandler, MessageHandler
+		if "inline_query" in update:
+			# Answering twice is harmless, skip the dedupe so that inline
+			# queries are served from memory alone
+			InlineQueryHandler(tenant.bot, update["inline_query"],
+					tenant.poll_store,
+					cache_time = self._inline_query_cache_time).handle()
+			return
+
 		if "update_id" in update:
-			if not self._should_process_update(update["update_id"]):
+			if not self._should_process_update(tenant.bot_id,
+					update["update_id"]):
 				return
 
 		if "message" in update:
 			# message request
-			MessageHandler(self._bot, update["message"],
-					self._make_session_class()).handle()
+			MessageHandler(tenant.bot, update["message"], tenant.poll_store,
+					bot_username = tenant.username).handle()
 		elif "callback_query" in update:
 			# inline request
-			CallbackQueryHandler(self._bot, update["callback_query"],
-					self._make_session_class()).handle()
+			CallbackQueryHandler(tenant.bot, update["callback_query"],
+					tenant.poll_store,
+					is_toast_response = self._is_toast_response).handle()
+		if self._vote_buffer is not None:
+			self._vote_buffer.flush_if_due()
+		# Like the vote buffer, there's no background thread here
+		self._scheduler.tick()
 
-	def _should_process_update(self, update_id):
+	def _should_process_update(self, bot_id, update_id):
 		import datetime
+		import app.model as model
 		now = datetime.datetime.utcnow()
 		dt = datetime.timedelta(weeks = 1)
 		from_time = now - dt
-		with model.open_session(self._make_session_class()) as s:
-			count = s.query(model.HandledUpdate) \
-					.filter(model.HandledUpdate.update_id == update_id) \
-					.filter(model.HandledUpdate.created_at >= from_time) \
-					.count()
+		with model.open_session(self._Session) as s:
+			count = _query_handled_update_count(s, bot_id, update_id, from_time)
 			if count == 0:
 				# Add this update
-				m = model.HandledUpdate(update_id = update_id)
+				m = model.HandledUpdate(bot_id = bot_id, update_id = update_id)
 				s.add(m)
 			# Cleanup old ones
 			s.query(model.HandledUpdate) \
@@ -85,6 +161,25 @@ class PawApp():
 					.delete(synchronize_session = False)
 			return (count == 0)
 
-	def _make_session_class(self):
-		sqlite_engine = create_engine("sqlite:///poll.db", echo = True)
-		return sessionmaker(bind = sqlite_engine)
+def _query_handled_update_count(session, bot_id, update_id, from_time):
+	import app.model as model
+	return session.query(model.HandledUpdate) \
+			.filter(model.HandledUpdate.update_id == update_id) \
+			.filter(model.HandledUpdate.bot_id == bot_id) \
+			.filter(model.HandledUpdate.created_at >= from_time) \
+			.count()
+
+def _get_webhook_path(tenant, secret):
+	if tenant.bot_id:
+		return f"{secret}/{tenant.bot_id}"
+	return secret
+
+def _glance_update(update):
+	if "message" in update:
+		return "chat", update["message"]
+	elif "callback_query" in update:
+		return "callback_query", update["callback_query"]
+	elif "inline_query" in update:
+		return "inline_query", update["inline_query"]
+	else:
+		return "update", update
@@ -0,0 +1,149 @@
+import datetime
+import heapq
+import threading
+import time
+from app.log import Log
+from app.metrics import Metrics
+
+## Runs the deadlines and reminders of the polls. The DB is the source of truth,
+#  the scheduler only keeps a heap of the upcoming due times so that it wakes up
+#  exactly when the next one is due. Due polls are then picked up from the DB
+#  through an index, in batches, and each one is claimed with a conditional
+#  update so that several workers never handle the same event twice
+#
+#  The heap is rebuilt from the DB on load() and every refresh_interval, which
+#  also picks up the deadlines set by other workers
+#
+#  One scheduler serves every bot in the process. @a targets is a list of
+#  (ActivePollStore, PollEventHandler), one per bot
+class PollScheduler:
+	## Create the scheduler from the scheduler field in config.json
+	@staticmethod
+	def from_config(targets, config):
+		config = config or {}
+		return PollScheduler(targets,
+				batch_size = config.get("batch_size", 100),
+				refresh_interval = config.get("refresh_interval", 5 * 60),
+				events_per_tick = config.get("events_per_update", 1))
+
+	def __init__(self, targets, batch_size = 100, refresh_interval = 5 * 60,
+			events_per_tick = 1):
+		self._targets = targets
+		self._batch_size = batch_size
+		# Kept small, on PAW tick() runs within the request of a webhook
+		self._events_per_tick = events_per_tick
+		self._refresh_interval = refresh_interval
+		# Due times as naive UTC datetimes, like in the DB. Entries outlive
+		# deadlines that were changed or removed, they merely cause a wake up
+		# that finds nothing to do
+		self._heap = []
+		# Due times scheduled since a load() started, None when not loading
+		self._scheduled_while_loading = None
+		self._refresh_at = 0
+		self._cond = threading.Condition()
+		for poll_store, _ in targets:
+			poll_store.set_schedule_listener(self.schedule)
+		Metrics.gauge("scheduler_pending_events", "Due times in the heap",
+				fn = lambda: len(self._heap))
+
+	def load(self):
+		"""Rebuild the heap from the DB"""
+		with self._cond:
+			self._scheduled_while_loading = []
+		try:
+			due_times = []
+			for poll_store, _ in self._targets:
+				due_times += poll_store.get_schedule()
+			with self._cond:
+				# Keep what was scheduled while we were loading, it may not have
+				# been committed in time to be read
+				self._heap = due_times + self._scheduled_while_loading
+				heapq.heapify(self._heap)
+				self._refresh_at = time.monotonic() + self._refresh_interval
+				self._cond.notify()
+		finally:
+			with self._cond:
+				self._scheduled_while_loading = None
+		Log.d(f"Scheduled {len(due_times)} events")
+
+	def start(self):
+		"""Run the events from a background thread. Without it, they only run on
+		tick()
+		"""
+		threading.Thread(target = self._run, name = "scheduler",
+				daemon = True).start()
+
+	def schedule(self, due_at):
+		with self._cond:
+			heapq.heappush(self._heap, due_at)
+			if self._scheduled_while_loading is not None:
+				self._scheduled_while_loading += [due_at]
+			if self._heap[0] == due_at:
+				# Sooner than what we're waiting for
+				self._cond.notify()
+
+	def tick(self):
+		"""Run up to events_per_tick of the events that are due, if any. Cheap if
+		there's none
+		"""
+		try:
+			if time.monotonic() >= self._refresh_at:
+				self.load()
+			if self._pop_due():
+				self._run_due(max_events = self._events_per_tick)
+		except Exception as e:
+			Log.e("Failed while running scheduled events", e)
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while True:
+					timeout = self._refresh_at - time.monotonic()
+					if self._heap:
+						timeout = min(timeout, (self._heap[0]
+								- datetime.datetime.utcnow()).total_seconds())
+					if timeout <= 0:
+						break
+					self._cond.wait(timeout)
+			try:
+				if time.monotonic() >= self._refresh_at:
+					self.load()
+				if self._pop_due():
+					self._run_due()
+			except Exception as e:
+				Log.e("Failed while running scheduled events", e)
+				# Don't spin on a broken DB
+				time.sleep(1)
+
+	def _pop_due(self):
+		now = datetime.datetime.utcnow()
+		product = False
+		with self._cond:
+			while self._heap and self._heap[0] <= now:
+				heapq.heappop(self._heap)
+				product = True
+		return product
+
+	def _run_due(self, max_events = None):
+		now = datetime.datetime.utcnow()
+		for poll_store, event_handler in self._targets:
+			for event, fn, on_event in (
+					("close", poll_store.close_due_polls, event_handler.on_closed),
+					("remind", poll_store.remind_due_polls,
+							event_handler.on_reminder)):
+				while max_events is None or max_events > 0:
+					limit = self._batch_size if max_events is None \
+							else min(self._batch_size, max_events)
+					polls = fn(now, limit = limit)
+					for poll in polls:
+						on_event(poll)
+					Metrics.counter("scheduler_events_total",
+							"Scheduled events handled", event = event).inc(len(polls))
+					if max_events is not None:
+						max_events -= len(polls)
+					if len(polls) < limit:
+						break
+				else:
+					# Out of budget, continue on the next tick
+					self.schedule(now)
+					return
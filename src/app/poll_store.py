@@ -0,0 +1,693 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+import random
+import threading
+import time
+import weakref
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
+from app.log import Log
+import app.model as model
+
+def _query_active_polls(session, bot_id, chat_id = None, poll_ids = None):
+	query = session.query(model.Poll).filter(model.Poll.bot_id == bot_id)
+	if chat_id is not None:
+		query = query.filter(model.Poll.chat_id == chat_id)
+	if poll_ids is not None:
+		query = query.filter(model.Poll.poll_id.in_(poll_ids))
+	return query \
+			.filter(model.Poll.closed_at == None) \
+			.outerjoin(model.Poll.choices) \
+			.options(contains_eager(model.Poll.choices)) \
+			.outerjoin(model.PollChoice.votes) \
+			.outerjoin(model.PollVote.user) \
+			.options(contains_eager(model.Poll.choices,
+					model.PollChoice.votes, model.PollVote.user)) \
+			.order_by(model.Poll.poll_id, model.PollChoice.poll_choice_id, model.PollVote.poll_vote_id) \
+			.all()
+
+## Raised when a poll has been changed by someone else since the snapshot passed
+#  to ActivePollStore was read. Start over with a fresh read, see
+#  retry_on_conflict()
+class ConflictError(Exception):
+	pass
+
+def retry_on_conflict(fn, retries = 5):
+	"""Call @a fn, and call it again if it raises ConflictError, at most
+	@a retries times in total. Retries are spread out with a random, growing
+	delay so that colliding writers don't collide again
+	"""
+	for i in range(retries):
+		try:
+			return fn()
+		except ConflictError as e:
+			if i == retries - 1:
+				raise
+			Log.d(f"Retrying after conflict: {e}")
+			time.sleep(random.uniform(0, 0.01 * 2 ** i))
+
+def _has_voted(poll, poll_choice_id, user_id):
+	choice = poll.find_choice(poll_choice_id)
+	return choice is not None and user_id in choice.voters
+
+def _can_vote(poll, poll_choice_id, user_id):
+	choice = poll.find_choice(poll_choice_id)
+	if choice is None or user_id in choice.voters:
+		return False
+	return poll.is_multiple_vote \
+			or not any(user_id in c.voters for c in poll.choices)
+
+## A voter as shown in the polls. Unlike the snapshots, it's updated in place
+#  when the user is renamed, see UserCache
+class ActiveUser:
+	def __init__(self, user_id, name):
+		self.user_id = user_id
+		self.set_name(name)
+
+	@property
+	def name(self):
+		return self._name_mention[0]
+
+	@property
+	def mention(self):
+		"""Markdown mention of the user, rendered once per name"""
+		return self._name_mention[1]
+
+	def set_name(self, name):
+		# Replaced as a whole so that readers never see a mismatched pair
+		self._name_mention = (name, f"[{name}](tg://user?id={self.user_id})")
+
+## One ActiveUser per user, shared by every snapshot they voted in. A user is
+#  kept for as long as a snapshot refers to them, and the @a max_recent most
+#  recently used ones are kept regardless, e.g. to vote again after an unvote
+class UserCache:
+	def __init__(self, max_recent = 1000):
+		self._max_recent = max_recent
+		self._users = weakref.WeakValueDictionary()
+		self._recent = OrderedDict()
+		self._lock = threading.Lock()
+
+	def find(self, user_id):
+		return self._users.get(user_id)
+
+	def get(self, user_id, name):
+		"""Return the user, created with @a name if not cached"""
+		with self._lock:
+			user = self._users.get(user_id)
+			if user is None:
+				user = ActiveUser(user_id, name)
+				self._users[user_id] = user
+			self._recent[user_id] = user
+			self._recent.move_to_end(user_id)
+			while len(self._recent) > self._max_recent:
+				self._recent.popitem(last = False)
+			return user
+
+class ActivePollChoice:
+	def __init__(self, poll_choice_id, text, voters = None):
+		self.poll_choice_id = poll_choice_id
+		self.text = text
+		# user_id -> ActiveUser, in the order of voting
+		self.voters = voters if voters is not None else OrderedDict()
+
+	@property
+	def votes(self):
+		return list(self.voters.values())
+
+	def with_voter(self, user):
+		voters = OrderedDict(self.voters)
+		voters[user.user_id] = user
+		return ActivePollChoice(self.poll_choice_id, self.text, voters)
+
+	def without_voter(self, user_id):
+		voters = OrderedDict(self.voters)
+		voters.pop(user_id, None)
+		return ActivePollChoice(self.poll_choice_id, self.text, voters)
+
+## In-memory copy of an active poll. It quacks like model.Poll so it can be
+#  rendered the same way. Snapshots are never modified once handed out, changes
+#  are made on a copy()
+class ActivePoll:
+	def __init__(self, poll_id, chat_id, title, creator_user_id,
+			is_multiple_vote, choices, version = 0, deadline_at = None,
+			remind_at = None):
+		self.poll_id = poll_id
+		self.chat_id = chat_id
+		self.title = title
+		self.creator_user_id = creator_user_id
+		self.is_multiple_vote = is_multiple_vote
+		self.choices = choices
+		# Poll.version in the DB this snapshot corresponds to
+		self.version = version
+		self.deadline_at = deadline_at
+		self.remind_at = remind_at
+
+	## Create the snapshot of @a poll_m, with its voters taken from @a users
+	@staticmethod
+	def from_model(poll_m, users):
+		choices = []
+		for c_m in poll_m.choices:
+			voters = OrderedDict((v_m.user_id, users.get(v_m.user_id,
+					# Votes are written along with their user, this is only
+					# for safety
+					v_m.user.name if v_m.user is not None else str(v_m.user_id)))
+					for v_m in c_m.votes)
+			choices += [ActivePollChoice(c_m.poll_choice_id, c_m.text, voters)]
+		return ActivePoll(poll_m.poll_id, poll_m.chat_id, poll_m.title,
+				poll_m.creator_user_id, poll_m.is_multiple_vote, choices,
+				poll_m.version, poll_m.deadline_at, poll_m.remind_at)
+
+	def copy(self, **changes):
+		values = dict(vars(self))
+		values.update(changes)
+		return ActivePoll(**values)
+
+	def find_choice(self, poll_choice_id):
+		for c in self.choices:
+			if c.poll_choice_id == poll_choice_id:
+				return c
+		return None
+
+	def replace_choice(self, choice):
+		return [choice if c.poll_choice_id == choice.poll_choice_id else c
+				for c in self.choices]
+
+## Authoritative in-memory state of the active polls, keyed by chat_id. Every
+#  mutation is written through to the DB before the memory is updated, reads are
+#  served from memory and only go to the DB when a chat is not cached. Chats
+#  without an active poll are cached as well
+#
+#  Mutations take the snapshot the caller has validated against, and raise
+#  ConflictError if the poll has changed since, whether in this process or, by
+#  comparing Poll.version, in another one. Handlers can thus run concurrently in
+#  several threads or worker processes. A process however only notices the
+#  changes made by another one when its cached copy is evicted or a write
+#  conflicts, set max_chats to 0 to always read the latest state from the DB
+#
+#  Votes are the exception, so that a busy poll doesn't turn every click into a
+#  conflict. They don't bump the version, the DB checks them on its own, and
+#  they're applied to whatever snapshot is cached by the time they're written
+#
+#  A store only sees the polls of one bot, @a bot_id, see model.Poll.bot_id
+class ActivePollStore:
+	## Create the store from the active_poll_store field in config.json
+	@staticmethod
+	def from_config(Session, config, vote_buffer = None, bot_id = ""):
+		config = config or {}
+		return ActivePollStore(Session,
+				max_chats = config.get("max_chats", 1000),
+				idle_timeout = config.get("idle_timeout", 24 * 60 * 60),
+				vote_buffer = vote_buffer, bot_id = bot_id)
+
+	def __init__(self, Session, max_chats = 1000, idle_timeout = 24 * 60 * 60,
+			vote_buffer = None, bot_id = ""):
+		self._Session = Session
+		self._bot_id = bot_id
+		self._max_chats = max_chats
+		self._idle_timeout = idle_timeout
+		self._vote_buffer = vote_buffer
+		# chat_id -> [ActivePoll or None, last access time], least recently
+		# used first
+		self._polls = OrderedDict()
+		# creator_user_id -> [chat_ids of the active polls, last access time],
+		# in the same manner
+		self._creators = OrderedDict()
+		self._users = UserCache(max_recent = max_chats)
+		# Buffered votes being journaled, (poll_id, user_id)
+		self._pending_voters = set()
+		# Bumped whenever a vote is written to a chat that is not cached, so
+		# that get() doesn't cache what it read before the vote
+		self._uncached_vote_count = 0
+		self._lock = threading.RLock()
+		self._schedule_listener = None
+
+	def set_schedule_listener(self, fn):
+		"""Call @a fn with the due time of every deadline or reminder set"""
+		self._schedule_listener = fn
+
+	def warm_up(self):
+		"""Load the most recent active polls in one go. This also prepares the
+		engine and its statement cache
+		"""
+		if self._max_chats <= 0:
+			return
+		pending_ops = self._get_pending_ops()
+		with model.open_session(self._Session) as s:
+			# Only the ones that fit, abandoned polls may pile up
+			poll_ids = [r.poll_id for r in s.query(model.Poll.poll_id)
+					.filter(model.Poll.bot_id == self._bot_id)
+					.filter(model.Poll.closed_at == None)
+					.order_by(model.Poll.poll_id.desc())
+					.limit(self._max_chats)]
+			polls = [self._make_poll(poll_m, pending_ops)
+					for poll_m in _query_active_polls(s, self._bot_id,
+							poll_ids = poll_ids)]
+		with self._lock:
+			for poll in polls:
+				self._put(str(poll.chat_id), poll)
+			Log.i(f"Loaded {len(self._polls)} active polls")
+
+	def get(self, chat_id):
+		"""Return the active poll in a chat, or None"""
+		chat_id = str(chat_id)
+		with self._lock:
+			entry = self._polls.get(chat_id)
+			if entry is not None:
+				entry[1] = time.monotonic()
+				self._polls.move_to_end(chat_id)
+				return entry[0]
+			uncached_vote_count = self._uncached_vote_count
+
+		# Don't block the other chats on the DB
+		pending_ops = self._get_pending_ops()
+		with model.open_session(self._Session) as s:
+			poll_ms = _query_active_polls(s, self._bot_id, chat_id)
+			poll = self._make_poll(poll_ms[0], pending_ops) if poll_ms else None
+		with self._lock:
+			entry = self._polls.get(chat_id)
+			if entry is not None:
+				# Someone was faster
+				return entry[0]
+			if uncached_vote_count == self._uncached_vote_count:
+				self._put(chat_id, poll)
+			return poll
+
+	def get_by_creator(self, creator_user_id):
+		"""Return the active polls created by a user, in any chat"""
+		with self._lock:
+			entry = self._creators.get(creator_user_id)
+			if entry is not None:
+				entry[1] = time.monotonic()
+				self._creators.move_to_end(creator_user_id)
+				chat_ids = entry[0]
+			else:
+				chat_ids = None
+
+		if chat_ids is None:
+			with model.open_session(self._Session) as s:
+				chat_ids = [r.chat_id for r in s.query(model.Poll.chat_id)
+						.filter(model.Poll.bot_id == self._bot_id)
+						.filter(model.Poll.creator_user_id == creator_user_id)
+						.filter(model.Poll.closed_at == None)
+						.order_by(model.Poll.poll_id)]
+			with self._lock:
+				self._put_creator(creator_user_id, chat_ids)
+		polls = [self.get(c) for c in chat_ids]
+		# The chat may have moved on since the list was cached
+		return [p for p in polls
+				if p is not None and p.creator_user_id == creator_user_id]
+
+	def create_poll(self, chat_id, title, choices, creator_user_id):
+		chat_id = str(chat_id)
+		try:
+			with model.open_session(self._Session) as s:
+				poll_m = model.Poll(bot_id = self._bot_id, title = title,
+						chat_id = chat_id, creator_user_id = creator_user_id,
+						is_multiple_vote = False, version = 0)
+				choice_ms = [model.PollChoice(text = c, poll = poll_m)
+						for c in choices]
+				s.add(poll_m)
+				s.flush()
+				poll = ActivePoll(poll_m.poll_id, chat_id, title, creator_user_id,
+						False, [ActivePollChoice(c_m.poll_choice_id, c_m.text)
+								for c_m in choice_ms])
+		except IntegrityError as e:
+			# Another poll was started in the meantime, see model.Poll
+			self._invalidate(chat_id)
+			raise ConflictError(f"Active poll exists in chat {chat_id}") from e
+		with self._lock:
+			self._put(chat_id, poll)
+			self._creators.pop(creator_user_id, None)
+		return poll
+
+	def add_choice(self, poll, text):
+		with self._write(poll) as s:
+			choice_m = model.PollChoice(text = text, poll_id = poll.poll_id)
+			s.add(choice_m)
+			s.flush()
+			choice = ActivePollChoice(choice_m.poll_choice_id, text)
+		return self._install(poll, poll.copy(choices = poll.choices + [choice],
+				version = poll.version + 1))
+
+	def remove_choice(self, poll, poll_choice_id):
+		with self._write(poll) as s:
+			# Bulk deletes skip the ORM cascade
+			s.query(model.PollVote) \
+					.filter(model.PollVote.poll_choice_id == poll_choice_id) \
+					.delete(synchronize_session = False)
+			s.query(model.PollChoice) \
+					.filter(model.PollChoice.poll_choice_id == poll_choice_id) \
+					.delete(synchronize_session = False)
+		return self._install(poll, poll.copy(
+				choices = [c for c in poll.choices
+						if c.poll_choice_id != poll_choice_id],
+				version = poll.version + 1))
+
+	def allow_multi_vote(self, poll):
+		with self._write(poll, is_multiple_vote = True):
+			pass
+		return self._install(poll, poll.copy(is_multiple_vote = True,
+				version = poll.version + 1))
+
+	def close_poll(self, poll):
+		"""Close @a poll. Returns it as it was closed, which may include votes
+		made since @a poll
+		"""
+		with self._write(poll) as s:
+			# Votes don't bump the version, read them back now that the write
+			# has locked them out
+			pending_ops = self._get_pending_ops()
+			product = self._make_poll(_query_active_polls(s, self._bot_id,
+					poll_ids = [poll.poll_id])[0], pending_ops)
+			s.query(model.Poll) \
+					.filter(model.Poll.poll_id == poll.poll_id) \
+					.update({"closed_at": datetime.datetime.utcnow()},
+							synchronize_session = False)
+		self._install(poll, None)
+		with self._lock:
+			self._creators.pop(poll.creator_user_id, None)
+		return product
+
+	def set_deadline(self, poll, deadline_at, remind_at = None):
+		"""Close @a poll automatically at @a deadline_at and remind the chat
+		about it at @a remind_at. None to unset
+		"""
+		with self._write(poll, deadline_at = deadline_at, remind_at = remind_at,
+				reminded_at = None):
+			pass
+		product = self._install(poll, poll.copy(deadline_at = deadline_at,
+				remind_at = remind_at, version = poll.version + 1))
+		if self._schedule_listener is not None:
+			for due_at in (deadline_at, remind_at):
+				if due_at is not None:
+					self._schedule_listener(due_at)
+		return product
+
+	def get_schedule(self):
+		"""Return the due times of the pending deadlines and reminders"""
+		with model.open_session(self._Session) as s:
+			product = [r[0] for r in s.query(model.Poll.deadline_at)
+					.filter(model.Poll.bot_id == self._bot_id)
+					.filter(model.Poll.closed_at == None)
+					.filter(model.Poll.deadline_at != None)]
+			product += [r[0] for r in s.query(model.Poll.remind_at)
+					.filter(model.Poll.bot_id == self._bot_id)
+					.filter(model.Poll.closed_at == None)
+					.filter(model.Poll.remind_at != None)
+					.filter(model.Poll.reminded_at == None)]
+		return product
+
+	def close_due_polls(self, now, limit = 100):
+		"""Close up to @a limit polls whose deadline has passed by @a now, in one
+		transaction. Returns the closed polls as they were when closed
+		"""
+		with model.open_session(self._Session) as s:
+			poll_ids = [r.poll_id for r in s.query(model.Poll.poll_id)
+					.filter(model.Poll.bot_id == self._bot_id)
+					.filter(model.Poll.closed_at == None)
+					.filter(model.Poll.deadline_at != None)
+					.filter(model.Poll.deadline_at <= now)
+					.order_by(model.Poll.deadline_at)
+					.limit(limit)]
+			if not poll_ids:
+				return []
+			# As in close_poll(), lock out the votes before reading them. Polls
+			# closed by another worker in the meantime are skipped by the read
+			s.query(model.Poll) \
+					.filter(model.Poll.poll_id.in_(poll_ids)) \
+					.filter(model.Poll.closed_at == None) \
+					.update({"version": model.Poll.version + 1},
+							synchronize_session = False)
+			pending_ops = self._get_pending_ops()
+			product = [self._make_poll(poll_m, pending_ops)
+					for poll_m in _query_active_polls(s, self._bot_id,
+							poll_ids = poll_ids)]
+			s.query(model.Poll) \
+					.filter(model.Poll.poll_id.in_([p.poll_id for p in product])) \
+					.update({"closed_at": now}, synchronize_session = False)
+		with self._lock:
+			for poll in product:
+				self._invalidate(poll.chat_id)
+				self._creators.pop(poll.creator_user_id, None)
+		return product
+
+	def remind_due_polls(self, now, limit = 100):
+		"""Mark up to @a limit polls whose reminder is due by @a now as reminded,
+		in one transaction. Returns these polls
+		"""
+		pending_ops = self._get_pending_ops()
+		with model.open_session(self._Session) as s:
+			# Polls past their deadline are about to be closed, which makes a
+			# reminder pointless. Mark them without sending, or they would stay
+			# due until then
+			s.query(model.Poll) \
+					.filter(model.Poll.bot_id == self._bot_id) \
+					.filter(model.Poll.closed_at == None) \
+					.filter(model.Poll.remind_at != None) \
+					.filter(model.Poll.reminded_at == None) \
+					.filter(model.Poll.deadline_at <= now) \
+					.update({"reminded_at": now}, synchronize_session = False)
+			poll_ids = [r.poll_id for r in s.query(model.Poll.poll_id)
+					.filter(model.Poll.bot_id == self._bot_id)
+					.filter(model.Poll.closed_at == None)
+					.filter(model.Poll.remind_at != None)
+					.filter(model.Poll.reminded_at == None)
+					.filter(model.Poll.remind_at <= now)
+					.filter(or_(model.Poll.deadline_at == None,
+							model.Poll.deadline_at > now))
+					.order_by(model.Poll.remind_at)
+					.limit(limit)]
+			if not poll_ids:
+				return []
+			product = []
+			for poll_m in _query_active_polls(s, self._bot_id,
+					poll_ids = poll_ids):
+				# Not part of the snapshot, no need to bump the version
+				count = s.query(model.Poll) \
+						.filter(model.Poll.poll_id == poll_m.poll_id) \
+						.filter(model.Poll.reminded_at == None) \
+						.update({"reminded_at": now}, synchronize_session = False)
+				if count == 1:
+					product += [self._make_poll(poll_m, pending_ops)]
+		return product
+
+	def vote(self, poll, poll_choice_id, user_id, user_name):
+		"""Add a vote by @a user_id, whose name is updated to @a user_name.
+		Returns the resulting snapshot, which may include other votes made since
+		@a poll
+		"""
+		self._get_existing_choice(poll, poll_choice_id)
+		if self._vote_buffer is not None:
+			# Buffered votes don't touch the DB, the user is written along with
+			# the vote by VoteBuffer._write_batch(). The buffer is only ever used
+			# by a single process, check against the memory instead
+			self._reserve_voter(poll, user_id,
+					lambda p: _can_vote(p, poll_choice_id, user_id))
+			try:
+				self._vote_buffer.vote(poll_choice_id, user_id, user_name)
+			except:
+				self._release_voter(poll, user_id)
+				raise
+		else:
+			user = self._users.find(user_id)
+			with model.open_session(self._Session) as s:
+				# Users not in memory may or may not be in the DB already
+				if user is None or user.name != user_name:
+					model.upsert_user(s, user_id, user_name)
+				is_added = model.insert_vote(s, poll_choice_id, user_id)
+			if not is_added:
+				# Our snapshot is behind, e.g. the user voted through another
+				# worker. The retry will read it again and see why
+				self._invalidate(poll.chat_id)
+				raise ConflictError(f"Vote of user {user_id} for choice "
+						f"{poll_choice_id} rejected")
+		user = self._rename_user(user_id, user_name)
+		return self._publish_vote(poll, poll_choice_id, user_id,
+				lambda c: c.with_voter(user))
+
+	def unvote(self, poll, poll_choice_id, user_id):
+		self._get_existing_choice(poll, poll_choice_id)
+		if self._vote_buffer is not None:
+			self._reserve_voter(poll, user_id,
+					lambda p: _has_voted(p, poll_choice_id, user_id))
+			try:
+				self._vote_buffer.unvote(poll_choice_id, user_id)
+			except:
+				self._release_voter(poll, user_id)
+				raise
+		else:
+			with model.open_session(self._Session) as s:
+				count = s.query(model.PollVote) \
+						.filter(model.PollVote.poll_choice_id == poll_choice_id) \
+						.filter(model.PollVote.user_id == user_id) \
+						.delete(synchronize_session = False)
+			if count == 0:
+				self._invalidate(poll.chat_id)
+				raise ConflictError(f"Vote of user {user_id} for choice "
+						f"{poll_choice_id} is gone")
+		return self._publish_vote(poll, poll_choice_id, user_id,
+				lambda c: c.without_voter(user_id))
+
+	def refresh_user(self, user_id, name):
+		"""Update the name of @a user_id if they are shown under another one,
+		e.g. when they unvote after changing it. Users not in memory are left
+		alone, the name is written on their next vote
+		"""
+		user = self._users.find(user_id)
+		if user is None or user.name == name:
+			return
+		if self._vote_buffer is not None:
+			# Journaled, so that it's written after the votes made before
+			self._vote_buffer.rename(user_id, name)
+		else:
+			with model.open_session(self._Session) as s:
+				model.upsert_user(s, user_id, name)
+		user.set_name(name)
+
+	def _reserve_voter(self, poll, user_id, is_allowed):
+		"""Check a buffered vote or unvote with @a is_allowed against the cached
+		snapshot of @a poll, and keep out the other ones by the same user until
+		it's published. The journal is then written without holding the lock
+		"""
+		with self._lock:
+			key = (poll.poll_id, user_id)
+			if key in self._pending_voters \
+					or not is_allowed(self._get_cached(poll) or poll):
+				raise ConflictError(f"User {user_id} has voted in poll "
+						f"{poll.poll_id} since")
+			self._pending_voters.add(key)
+
+	def _release_voter(self, poll, user_id):
+		with self._lock:
+			self._pending_voters.discard((poll.poll_id, user_id))
+
+	def _publish_vote(self, poll, poll_choice_id, user_id, change):
+		"""Apply @a change, a function of an ActivePollChoice, to the cached
+		snapshot of @a poll. Returns the new snapshot
+		"""
+		chat_id = str(poll.chat_id)
+		with self._lock:
+			self._pending_voters.discard((poll.poll_id, user_id))
+			current = self._get_cached(poll)
+			if current is None:
+				# Not cached, or cached as something else, the next get() will
+				# read the vote back
+				self._polls.pop(chat_id, None)
+				self._uncached_vote_count += 1
+				current = poll
+			choice = current.find_choice(poll_choice_id)
+			if choice is None:
+				# Removed meanwhile
+				self._polls.pop(chat_id, None)
+				return current
+			product = current.copy(choices = current.replace_choice(
+					change(choice)))
+			if chat_id in self._polls:
+				self._put(chat_id, product)
+			return product
+
+	def _get_cached(self, poll):
+		"""Return the cached snapshot of @a poll, which may be newer, or None"""
+		entry = self._polls.get(str(poll.chat_id))
+		if entry is None or entry[0] is None \
+				or entry[0].poll_id != poll.poll_id:
+			return None
+		return entry[0]
+
+	@contextmanager
+	def _write(self, poll, **values):
+		"""Open a transaction that bumps Poll.version, on the condition that it's
+		still the one in @a poll. @a values are updated along with it
+		"""
+		self._check_current(poll)
+		try:
+			with model.open_session(self._Session) as s:
+				values["version"] = poll.version + 1
+				count = s.query(model.Poll) \
+						.filter(model.Poll.poll_id == poll.poll_id) \
+						.filter(model.Poll.version == poll.version) \
+						.update(values, synchronize_session = False)
+				if count != 1:
+					raise ConflictError(f"Poll {poll.poll_id} is no longer at "
+							f"version {poll.version}")
+				yield s
+		except ConflictError:
+			self._invalidate(poll.chat_id)
+			raise
+
+	def _check_current(self, poll):
+		with self._lock:
+			entry = self._polls.get(str(poll.chat_id))
+			if entry is not None and entry[0] is not poll:
+				raise ConflictError(f"Poll {poll.poll_id} has changed")
+
+	def _install(self, old_poll, poll):
+		"""Replace @a old_poll in the cache with @a poll"""
+		chat_id = str(old_poll.chat_id)
+		with self._lock:
+			entry = self._polls.get(chat_id)
+			if entry is None or entry[0] is old_poll:
+				self._put(chat_id, poll)
+			else:
+				# Reloaded while we were writing, it may or may not have our change
+				self._polls.pop(chat_id)
+		return poll
+
+	def _invalidate(self, chat_id):
+		with self._lock:
+			self._polls.pop(str(chat_id), None)
+
+	def _get_existing_choice(self, poll, poll_choice_id):
+		choice = poll.find_choice(poll_choice_id)
+		if choice is None:
+			raise KeyError(f"No choice {poll_choice_id} in poll {poll.poll_id}")
+		return choice
+
+	def _get_pending_ops(self):
+		"""Votes not written to the DB yet, to be passed to _make_poll(). Must be
+		taken before reading the polls, or a flush in between may commit the ops
+		after the read and drop them before the overlay
+		"""
+		if self._vote_buffer is None:
+			return []
+		return self._vote_buffer.get_pending_ops()
+
+	def _make_poll(self, poll_m, pending_ops):
+		poll = ActivePoll.from_model(poll_m, self._users)
+		if pending_ops:
+			self._vote_buffer.overlay(poll, self._users, pending_ops)
+		return poll
+
+	def _rename_user(self, user_id, name):
+		user = self._users.get(user_id, name)
+		if user.name != name:
+			# Shows up in every poll they voted in
+			user.set_name(name)
+		return user
+
+	def _put(self, chat_id, poll):
+		if self._max_chats <= 0:
+			return
+		now = time.monotonic()
+		self._polls[chat_id] = [poll, now]
+		self._polls.move_to_end(chat_id)
+		self._evict(self._polls, now)
+
+	def _put_creator(self, creator_user_id, chat_ids):
+		if self._max_chats <= 0:
+			return
+		now = time.monotonic()
+		self._creators[creator_user_id] = [chat_ids, now]
+		self._creators.move_to_end(creator_user_id)
+		self._evict(self._creators, now)
+
+	def _evict(self, entries, now):
+		while len(entries) > self._max_chats:
+			entries.popitem(last = False)
+		# Least recently used first, so we can stop at the first fresh one
+		while entries:
+			_, last_access = next(iter(entries.values()))
+			if now - last_access < self._idle_timeout:
+				break
+			entries.popitem(last = False)
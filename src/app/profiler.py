@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+import cProfile
+import datetime
+import itertools
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+from sqlalchemy import event
+from app.log import Log
+
+def make_update_tag(flavor, msg):
+	"""Name an update after its command, with the trailing ids elided, e.g.
+	/do-vote-…
+	"""
+	if flavor == "callback_query":
+		text = msg.get("data") or ""
+	elif flavor == "chat":
+		text = msg.get("text") or ""
+		if not text.startswith("/"):
+			return "message"
+	else:
+		return flavor
+	cmd = text.split()[0].split("@")[0] if text.strip() else ""
+	return re.sub(r"\d+$", "…", cmd) or flavor
+
+## Opt-in diagnostics for production. A fraction of the updates are run under
+#  cProfile and tracemalloc, and their profiles and allocation snapshots are
+#  dumped to disk, tagged with the command. SQL statements slower than a
+#  threshold are logged together with their parameters
+class Profiler:
+	## Create the profiler from the profiling field in config.json. Everything
+	#  is off if the field is missing
+	@staticmethod
+	def from_config(config):
+		config = config or {}
+		return Profiler(output_dir = config.get("output_dir", "profiles"),
+				sample_rate = config.get("sample_rate", 0),
+				is_tracemalloc = config.get("tracemalloc", True),
+				slow_query_ms = config.get("slow_query_ms"),
+				is_echo = config.get("echo", False))
+
+	def __init__(self, output_dir = "profiles", sample_rate = 0,
+			is_tracemalloc = True, slow_query_ms = None, is_echo = False):
+		self._output_dir = output_dir
+		self._sample_rate = sample_rate
+		self._is_tracemalloc = is_tracemalloc
+		self._slow_query_ms = slow_query_ms
+		self._is_echo = is_echo
+		# cProfile and tracemalloc don't nest well, profile one update at a time
+		self._lock = threading.Lock()
+		self._counter = itertools.count()
+
+	@property
+	def is_echo(self):
+		"""Whether the engine should log every statement"""
+		return self._is_echo
+
+	def install(self, engine):
+		"""Hook the slow query log into @a engine"""
+		if self._slow_query_ms is None:
+			return
+		threshold = self._slow_query_ms / 1000
+
+		@event.listens_for(engine, "before_cursor_execute")
+		def _before_cursor_execute(conn, cursor, statement, parameters, context,
+				executemany):
+			conn.info.setdefault("query_start_time", []).append(
+					time.perf_counter())
+
+		@event.listens_for(engine, "after_cursor_execute")
+		def _after_cursor_execute(conn, cursor, statement, parameters, context,
+				executemany):
+			elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+			if elapsed >= threshold:
+				Log.w(f"Slow query ({elapsed * 1000:.1f} ms): {statement}\n"
+						f"Parameters: {parameters}")
+
+	@contextmanager
+	def profile(self, tag):
+		"""Profile the enclosed block if this update is sampled"""
+		if self._sample_rate <= 0 or random.random() >= self._sample_rate \
+				or not self._lock.acquire(blocking = False):
+			yield
+			return
+
+		try:
+			is_tracing = self._is_tracemalloc and not tracemalloc.is_tracing()
+			if is_tracing:
+				tracemalloc.start()
+			profile = cProfile.Profile()
+			profile.enable()
+			try:
+				yield
+			finally:
+				profile.disable()
+				snapshot = tracemalloc.take_snapshot() if is_tracing else None
+				if is_tracing:
+					tracemalloc.stop()
+				self._dump(tag, profile, snapshot)
+		finally:
+			self._lock.release()
+
+	def _dump(self, tag, profile, snapshot):
+		try:
+			os.makedirs(self._output_dir, exist_ok = True)
+			name = "%s-%d-%s" % (
+					datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+					next(self._counter), re.sub(r"[^\w-]", "_", tag))
+			path = os.path.join(self._output_dir, name)
+			profile.dump_stats(path + ".prof")
+			if snapshot is not None:
+				snapshot.dump(path + ".tracemalloc")
+			Log.d(f"Profiled {tag}: {path}")
+		except Exception as e:
+			# Never fail an update because of diagnostics
+			Log.e("Failed while dumping profile", e)
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+## Measure the cold start latency of the entry points. Every sample runs in a
+#  fresh interpreter inside a scratch directory holding its own config.json and
+#  poll.db, and no request is ever sent to Telegram
+#
+#  PYTHONPATH=src python3 src/app/script/bench_startup.py [-n 10]
+
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+		os.path.abspath(__file__))))
+_WSGI_FILE = os.path.join(os.path.dirname(_SRC_DIR), "misc",
+		"pythonanywhere_com_wsgi.py")
+
+_TARGETS = {
+	# The same path as app/__init__.py, minus the network bits in _start()
+	"app": """
+import app
+from app.standalone_app import StandaloneApp
+StandaloneApp().warm_up()
+""",
+	"wsgi": f"""
+import runpy
+runpy.run_path({_WSGI_FILE!r})
+""",
+}
+
+_CHILD = """
+import time
+_begin = time.perf_counter()
+%s
+print(time.perf_counter() - _begin)
+"""
+
+def _prepare_dir(path):
+	config = {
+		"telegram_bot_token": "0:bench",
+		"paw_app": {
+			"url": "https://localhost",
+			"webhook_secret": "bench",
+			"register_webhook": False,
+		},
+	}
+	with open(os.path.join(path, "config.json"), "w") as f:
+		f.write(json.dumps(config))
+	subprocess.run([sys.executable, "-c",
+			"from app.script.create_sqlite_db import create_sqlite_db;"
+			"create_sqlite_db()"],
+			cwd = path, env = _make_env(), check = True)
+
+def _make_env():
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(filter(None,
+			[_SRC_DIR, env.get("PYTHONPATH")]))
+	return env
+
+def _sample(path, code):
+	begin = time.perf_counter()
+	result = subprocess.run([sys.executable, "-c", _CHILD % code], cwd = path,
+			env = _make_env(), check = True, stdout = subprocess.PIPE,
+			stderr = subprocess.DEVNULL, universal_newlines = True)
+	total = time.perf_counter() - begin
+	# The last line is ours, anything before is the app's own logging
+	inner = float(result.stdout.strip().split("\n")[-1])
+	return total, inner
+
+def _report(name, samples):
+	for i, label in enumerate(["process", "startup"]):
+		values = [s[i] * 1000 for s in samples]
+		print(f"{name:>6} {label:>8}: min {min(values):8.1f} ms"
+				f"  median {statistics.median(values):8.1f} ms"
+				f"  max {max(values):8.1f} ms")
+
+def bench_startup(targets, count):
+	with tempfile.TemporaryDirectory() as path:
+		_prepare_dir(path)
+		for name in targets:
+			samples = [_sample(path, _TARGETS[name]) for _ in range(count)]
+			_report(name, samples)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Benchmark cold start")
+	parser.add_argument("-n", "--count", type = int, default = 10,
+			help = "Number of samples per target")
+	parser.add_argument("targets", nargs = "*",
+			help = "Entry points to measure (%s), all of them by default"
+					% ", ".join(sorted(_TARGETS)))
+	args = parser.parse_args()
+	for t in args.targets:
+		if t not in _TARGETS:
+			parser.error(f"Unknown target: {t}")
+	bench_startup(args.targets or sorted(_TARGETS), args.count)
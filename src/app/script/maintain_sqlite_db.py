@@ -0,0 +1,198 @@
+import argparse
+import datetime
+import time
+from sqlalchemy import create_engine, delete, exc, select, text
+import app.model as model
+
+## Housekeeping for a long running poll.db. Every step can be run against a
+#  live bot, work is split into short transactions with a pause in between so
+#  that the bot is never blocked on the write lock for long
+#
+#  PYTHONPATH=src python3 src/app/script/maintain_sqlite_db.py report
+#  PYTHONPATH=src python3 src/app/script/maintain_sqlite_db.py all
+
+def _create_engine(db_url, busy_timeout):
+	# Autocommit so that each statement is its own transaction, VACUUM and some
+	# of the pragmas can't run inside one anyway
+	return create_engine(db_url, isolation_level = "AUTOCOMMIT",
+			connect_args = {"timeout": busy_timeout})
+
+def _pragma(conn, name):
+	return conn.execute(text(f"PRAGMA {name}")).scalar()
+
+def prune(engine, days = 7, batch_size = 500, pause = 0.1):
+	"""Delete the handled updates older than @a days. The webhook only looks
+	back a week to dedupe, see PawApp._should_process_update
+	"""
+	cutoff = datetime.datetime.utcnow() - datetime.timedelta(days = days)
+	table = model.HandledUpdate.__table__
+	ids = select(table.c._id) \
+			.where(table.c.created_at < cutoff) \
+			.limit(batch_size) \
+			.scalar_subquery()
+	total = 0
+	with engine.connect() as conn:
+		while True:
+			count = conn.execute(delete(table).where(table.c._id.in_(ids))) \
+					.rowcount
+			total += count
+			if count < batch_size:
+				break
+			time.sleep(pause)
+	print(f"Pruned {total} handled updates older than {cutoff}")
+
+def vacuum(engine, pages = 100, pause = 0.1, is_full = False):
+	"""Return free pages to the file system, @a pages at a time. This requires
+	incremental auto vacuum, which can only be turned on by a full VACUUM when
+	@a is_full is true. The full VACUUM rewrites the whole file and blocks
+	writers until it's done
+	"""
+	with engine.connect() as conn:
+		if is_full:
+			conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+			begin = time.monotonic()
+			conn.execute(text("VACUUM"))
+			print(f"Full VACUUM took {time.monotonic() - begin:.1f} s")
+			return
+
+		# 0: NONE, 1: FULL, 2: INCREMENTAL
+		if _pragma(conn, "auto_vacuum") != 2:
+			print("Incremental vacuum not enabled, run vacuum --full once while "
+					"the bot is quiet")
+			return
+		before = _pragma(conn, "freelist_count")
+		while True:
+			free = _pragma(conn, "freelist_count")
+			if not free:
+				break
+			# pysqlite only steps the statement once, which frees a single page,
+			# so a batch is that many statements in one transaction
+			conn.execute(text("BEGIN IMMEDIATE"))
+			try:
+				for _ in range(min(free, pages)):
+					conn.execute(text("PRAGMA incremental_vacuum(1)"))
+			finally:
+				conn.execute(text("COMMIT"))
+			time.sleep(pause)
+		print(f"Freed {before} pages")
+
+def optimize(engine, is_full = False):
+	"""Refresh the statistics used by the query planner. By default only the
+	tables that need it are analyzed, with a limited sample
+	"""
+	with engine.connect() as conn:
+		if is_full:
+			conn.execute(text("ANALYZE"))
+		else:
+			conn.execute(text("PRAGMA analysis_limit = 400"))
+			conn.execute(text("PRAGMA optimize"))
+	print("Optimized")
+
+def checkpoint(engine):
+	"""Copy the WAL back into the DB and truncate it"""
+	with engine.connect() as conn:
+		mode = _pragma(conn, "journal_mode")
+		if mode != "wal":
+			print(f"Not in WAL mode ({mode}), nothing to checkpoint")
+			return
+		is_busy, log_pages, checkpointed_pages = conn.execute(
+				text("PRAGMA wal_checkpoint(TRUNCATE)")).one()
+		if is_busy:
+			print(f"Checkpoint incomplete, {checkpointed_pages}/{log_pages} pages "
+					"copied while readers were active")
+		else:
+			print(f"Checkpointed {checkpointed_pages} pages")
+
+def check(engine, is_full = False):
+	"""Check the DB for corruption. Returns whether it's fine"""
+	with engine.connect() as conn:
+		pragma = "integrity_check" if is_full else "quick_check"
+		errors = [r[0] for r in conn.execute(text(f"PRAGMA {pragma}"))]
+		errors += [f"Foreign key violation in {r[0]}, rowid {r[1]}"
+				for r in conn.execute(text("PRAGMA foreign_key_check"))]
+	if errors == ["ok"]:
+		print("OK")
+		return True
+	for e in errors:
+		print(e)
+	return False
+
+def report(engine):
+	"""Print the size of the DB and of each table and index"""
+	with engine.connect() as conn:
+		page_size = _pragma(conn, "page_size")
+		page_count = _pragma(conn, "page_count")
+		free = _pragma(conn, "freelist_count")
+		print(f"File: {page_count * page_size / 1024:.1f} KiB, "
+				f"{page_count} pages of {page_size} bytes")
+		print(f"Free: {free} pages ({free / max(page_count, 1):.1%})")
+		print(f"Journal mode: {_pragma(conn, 'journal_mode')}, auto vacuum: "
+				f"{['none', 'full', 'incremental'][_pragma(conn, 'auto_vacuum')]}")
+
+		tables = [r[0] for r in conn.execute(text("SELECT name FROM sqlite_master "
+				"WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"))]
+		rows = {t: conn.execute(text(f"SELECT COUNT(*) FROM \"{t}\"")).scalar()
+				for t in tables}
+		try:
+			# Unused bytes in the pages of an object is a measure of how
+			# fragmented it is
+			stats = conn.execute(text("SELECT name, COUNT(*), SUM(pgsize), "
+					"SUM(unused) FROM dbstat GROUP BY name ORDER BY name")).all()
+		except exc.OperationalError:
+			# SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+			stats = []
+
+	print()
+	print(f"{'Name':<32} {'Rows':>10} {'Pages':>8} {'KiB':>10} {'Unused':>7}")
+	for name, pages, size, unused in stats:
+		print(f"{name:<32} {rows.get(name, ''):>10} {pages:>8} "
+				f"{size / 1024:>10.1f} {unused / max(size, 1):>7.1%}")
+	if not stats:
+		for name in tables:
+			print(f"{name:<32} {rows[name]:>10}")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Maintain poll.db")
+	parser.add_argument("--db-url", default = model.DEFAULT_DB_URL)
+	parser.add_argument("--busy-timeout", type = float, default = 5,
+			help = "Seconds to wait for the bot to release the DB")
+	parser.add_argument("--pause", type = float, default = 0.1,
+			help = "Seconds to sleep between batches")
+	subparsers = parser.add_subparsers(dest = "command")
+	subparsers.required = True
+
+	p = subparsers.add_parser("prune", help = "Delete old handled updates")
+	p.add_argument("--days", type = float, default = 7)
+	p.add_argument("--batch-size", type = int, default = 500)
+	p = subparsers.add_parser("vacuum", help = "Incremental VACUUM")
+	p.add_argument("--pages", type = int, default = 100,
+			help = "Pages to free per batch")
+	p.add_argument("--full", action = "store_true",
+			help = "Full VACUUM and enable incremental auto vacuum")
+	p = subparsers.add_parser("optimize", help = "PRAGMA optimize")
+	p.add_argument("--full", action = "store_true", help = "Full ANALYZE")
+	subparsers.add_parser("checkpoint", help = "Checkpoint and truncate the WAL")
+	p = subparsers.add_parser("check", help = "Check integrity")
+	p.add_argument("--full", action = "store_true",
+			help = "integrity_check instead of quick_check")
+	subparsers.add_parser("report", help = "Sizes, row counts and fragmentation")
+	subparsers.add_parser("all",
+			help = "prune, vacuum, optimize and checkpoint with the defaults")
+	args = parser.parse_args()
+
+	engine = _create_engine(args.db_url, args.busy_timeout)
+	if args.command in ("prune", "all"):
+		prune(engine, days = getattr(args, "days", 7),
+				batch_size = getattr(args, "batch_size", 500), pause = args.pause)
+	if args.command in ("vacuum", "all"):
+		vacuum(engine, pages = getattr(args, "pages", 100), pause = args.pause,
+				is_full = getattr(args, "full", False))
+	if args.command in ("optimize", "all"):
+		optimize(engine, is_full = getattr(args, "full", False))
+	if args.command in ("checkpoint", "all"):
+		checkpoint(engine)
+	if args.command == "check":
+		if not check(engine, is_full = args.full):
+			raise SystemExit(1)
+	if args.command == "report":
+		report(engine)
@@ -0,0 +1,103 @@
+from sqlalchemy import create_engine, inspect, text
+import app.model as model
+
+def _has_column(insp, table, name):
+	return name in [c["name"] for c in insp.get_columns(table)]
+
+def _add_column(table, name, type):
+	def _add(conn):
+		conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {type}"))
+	return _add
+
+def _get_model_index(table, name):
+	return next(i for i in model.Base.metadata.tables[table].indexes
+			if i.name == name)
+
+def _has_index(insp, table, name):
+	"""Whether the index exists, on the columns it has in the model"""
+	columns = [c.name for c in _get_model_index(table, name).columns]
+	return any(i["name"] == name and i["column_names"] == columns
+			for i in insp.get_indexes(table))
+
+def _add_index(table, name):
+	def _add(conn):
+		# Replace an outdated one
+		conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+		_get_model_index(table, name).create(conn)
+	return _add
+
+def _move_user_names(conn):
+	# The user table itself is created up to date, keep the latest name of each
+	# voter
+	conn.execute(text("INSERT OR IGNORE INTO \"user\" (user_id, name, updated_at) "
+			"SELECT user_id, user_name, created_at FROM poll_vote AS v "
+			"WHERE poll_vote_id = (SELECT MAX(poll_vote_id) FROM poll_vote "
+			"WHERE user_id = v.user_id)"))
+	# Older SQLite can't drop a column, rebuild the table instead
+	conn.execute(text("ALTER TABLE poll_vote RENAME TO poll_vote_old"))
+	for index in inspect(conn).get_indexes("poll_vote_old"):
+		conn.execute(text(f"DROP INDEX {index['name']}"))
+	model.PollVote.__table__.create(conn)
+	conn.execute(text("INSERT INTO poll_vote "
+			"(poll_vote_id, poll_choice_id, user_id, created_at) "
+			"SELECT poll_vote_id, poll_choice_id, user_id, created_at "
+			"FROM poll_vote_old"))
+	conn.execute(text("DROP TABLE poll_vote_old"))
+
+# (name, function to check whether it's needed, function to apply it). Columns
+# come first, as the indexes may cover them
+_MIGRATIONS = [
+	("Add poll.version",
+			lambda insp: not _has_column(insp, "poll", "version"),
+			_add_column("poll", "version", "INTEGER NOT NULL DEFAULT 0")),
+	("Add poll.deadline_at",
+			lambda insp: not _has_column(insp, "poll", "deadline_at"),
+			_add_column("poll", "deadline_at", "DATETIME")),
+	("Add poll.remind_at",
+			lambda insp: not _has_column(insp, "poll", "remind_at"),
+			_add_column("poll", "remind_at", "DATETIME")),
+	("Add poll.reminded_at",
+			lambda insp: not _has_column(insp, "poll", "reminded_at"),
+			_add_column("poll", "reminded_at", "DATETIME")),
+	# Existing polls and updates belong to the bot with the empty id, which is
+	# the one served when config.json has no bots field
+	("Add poll.bot_id",
+			lambda insp: not _has_column(insp, "poll", "bot_id"),
+			_add_column("poll", "bot_id", "VARCHAR NOT NULL DEFAULT ''")),
+	("Add handled_update.bot_id",
+			lambda insp: not _has_column(insp, "handled_update", "bot_id"),
+			_add_column("handled_update", "bot_id",
+					"VARCHAR NOT NULL DEFAULT ''")),
+	("Move poll_vote.user_name to user",
+			lambda insp: _has_column(insp, "poll_vote", "user_name"),
+			_move_user_names),
+	("Add ix_poll_active_chat_id",
+			lambda insp: not _has_index(insp, "poll", "ix_poll_active_chat_id"),
+			_add_index("poll", "ix_poll_active_chat_id")),
+	("Add ix_poll_active_creator_user_id",
+			lambda insp: not _has_index(insp, "poll",
+					"ix_poll_active_creator_user_id"),
+			_add_index("poll", "ix_poll_active_creator_user_id")),
+	("Add ix_poll_active_deadline_at",
+			lambda insp: not _has_index(insp, "poll", "ix_poll_active_deadline_at"),
+			_add_index("poll", "ix_poll_active_deadline_at")),
+	("Add ix_poll_active_remind_at",
+			lambda insp: not _has_index(insp, "poll", "ix_poll_active_remind_at"),
+			_add_index("poll", "ix_poll_active_remind_at")),
+]
+
+def migrate_sqlite_db(db_url = model.DEFAULT_DB_URL):
+	"""Bring an existing DB up to date with the model. Migrations already
+	applied are skipped, so it's safe to run this more than once
+	"""
+	engine = create_engine(db_url)
+	# Tables that don't exist at all are created up to date
+	model.Base.metadata.create_all(engine)
+	with engine.begin() as conn:
+		for name, is_needed, fn in _MIGRATIONS:
+			if is_needed(inspect(conn)):
+				print(f"Applying: {name}")
+				fn(conn)
+
+if __name__ == "__main__":
+	migrate_sqlite_db()
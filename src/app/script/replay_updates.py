@@ -0,0 +1,207 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import app.model as model
+from app.message_handler import CallbackQueryHandler, InlineQueryHandler, \
+		MessageHandler
+from app.poll_store import ActivePollStore
+from app.profiler import make_update_tag
+from app.script.migrate_sqlite_db import migrate_sqlite_db
+from app.update_recorder import Anonymiser, read_recording
+from app.vote_buffer import VoteBuffer
+
+## Feed updates captured by UpdateRecorder to the handlers, against a scratch
+#  copy of the DB and a bot that never talks to Telegram, and report the
+#  throughput and the latency of each kind of update
+#
+#  The choice ids in the recorded buttons only line up if the replay starts from
+#  the DB as it was when the recording started. Pass a copy of it with --seed-db,
+#  along with the salt of the recording so that its users are anonymised the
+#  same way
+#
+#  PYTHONPATH=src python3 src/app/script/replay_updates.py updates-*.jsonl.gz \
+#      [--speed 10] [--seed-db poll.db.bak --salt ...]
+
+class _StubBot:
+	def __init__(self, latency = 0):
+		self._latency = latency
+		self._message_ids = itertools.count(1)
+		self.calls = defaultdict(int)
+		self._lock = threading.Lock()
+
+	def __getattr__(self, name):
+		def _call(*args, **kwargs):
+			with self._lock:
+				self.calls[name] += 1
+			if self._latency:
+				time.sleep(self._latency)
+			if name == "deleteMessage":
+				return True
+			return {"message_id": next(self._message_ids)}
+		return _call
+
+class _ErrorCounter(logging.Handler):
+	def __init__(self):
+		super().__init__(logging.ERROR)
+		self.count = 0
+
+	def emit(self, record):
+		self.count += 1
+
+def _anonymise_db(Session, anonymiser):
+	with model.open_session(Session) as s:
+		for poll_m in s.query(model.Poll):
+			poll_m.creator_user_id = anonymiser.anonymise_id(poll_m.creator_user_id)
+			try:
+				poll_m.chat_id = str(anonymiser.anonymise_id(int(poll_m.chat_id)))
+			except ValueError:
+				# Public channel name
+				pass
+		for user_m in s.query(model.User):
+			user_m.name = anonymiser.anonymise_name(user_m.user_id)
+			user_m.user_id = anonymiser.anonymise_id(user_m.user_id)
+		for vote_m in s.query(model.PollVote):
+			vote_m.user_id = anonymiser.anonymise_id(vote_m.user_id)
+
+def _percentile(values, p):
+	values = sorted(values)
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def _report(latencies, elapsed, bot, errors):
+	count = sum(len(v) for v in latencies.values())
+	print(f"Replayed {count} updates in {elapsed:.2f} s, "
+			f"{count / max(elapsed, 1e-9):.1f} updates/s, {errors} errors")
+	print(f"Bot API calls: " + ", ".join(f"{k} {v}"
+			for k, v in sorted(bot.calls.items())))
+	print()
+	print(f"{'Update':<24} {'Count':>7} {'p50 ms':>9} {'p90 ms':>9} "
+			f"{'p99 ms':>9} {'max ms':>9}")
+	rows = sorted(latencies.items()) + [("(all)",
+			list(itertools.chain(*latencies.values())))]
+	for tag, values in rows:
+		if not values:
+			continue
+		ms = [v * 1000 for v in values]
+		print(f"{tag:<24} {len(ms):>7} {_percentile(ms, 50):>9.2f} "
+				f"{_percentile(ms, 90):>9.2f} {_percentile(ms, 99):>9.2f} "
+				f"{max(ms):>9.2f}")
+
+def replay(paths, speed = 1, threads = 1, max_gap = 60, seed_db = None,
+		salt = None, bot_latency = 0, max_chats = 1000, is_vote_buffer = False):
+	"""Replay the recordings at @a paths, merged by arrival time. The gaps
+	between updates are divided by @a speed and capped at @a max_gap seconds,
+	a @a speed of 0 replays as fast as possible. Latency is measured from when
+	an update is due, so it includes the time spent waiting for a free thread.
+	There's no due time when replaying as fast as possible, it's measured from
+	when a thread picks the update up instead
+	"""
+	records = sorted((r for p in paths for r in read_recording(p)),
+			key = lambda r: r[0])
+	with tempfile.TemporaryDirectory() as dir:
+		db_path = os.path.join(dir, "poll.db")
+		if seed_db:
+			shutil.copyfile(seed_db, db_path)
+		# The seed may come from an older version
+		migrate_sqlite_db(f"sqlite:///{db_path}")
+		Session = model.create_session_class(f"sqlite:///{db_path}")
+		if seed_db and salt:
+			_anonymise_db(Session, Anonymiser(salt))
+
+		vote_buffer = None
+		if is_vote_buffer:
+			vote_buffer = VoteBuffer(Session, os.path.join(dir, "vote_journal.log"))
+			vote_buffer.recover()
+			vote_buffer.start()
+		# One store per bot in the recording, like in the app
+		poll_stores = {}
+		for bot_id in set(r[1] for r in records):
+			poll_stores[bot_id] = ActivePollStore(Session, max_chats = max_chats,
+					vote_buffer = vote_buffer, bot_id = bot_id)
+			poll_stores[bot_id].warm_up()
+		bot = _StubBot(bot_latency)
+		latencies = defaultdict(list)
+		lock = threading.Lock()
+
+		def _handle(bot_id, update, due):
+			if due is None:
+				due = time.perf_counter()
+			poll_store = poll_stores[bot_id]
+			if "message" in update:
+				tag = make_update_tag("chat", update["message"])
+				MessageHandler(bot, update["message"], poll_store).handle()
+			elif "callback_query" in update:
+				tag = make_update_tag("callback_query", update["callback_query"])
+				CallbackQueryHandler(bot, update["callback_query"],
+						poll_store).handle()
+			elif "inline_query" in update:
+				tag = make_update_tag("inline_query", update["inline_query"])
+				InlineQueryHandler(bot, update["inline_query"],
+						poll_store).handle()
+			else:
+				return
+			latency = time.perf_counter() - due
+			with lock:
+				latencies[tag] += [latency]
+
+		begin = time.perf_counter()
+		offset = 0
+		last_t = records[0][0] if records else 0
+		with ThreadPoolExecutor(max_workers = threads) as executor:
+			for t, bot_id, update in records:
+				if speed > 0:
+					offset += min(t - last_t, max_gap) / speed
+					last_t = t
+					due = begin + offset
+					delay = due - time.perf_counter()
+					if delay > 0:
+						time.sleep(delay)
+				else:
+					due = None
+				executor.submit(_handle, bot_id, update, due)
+		elapsed = time.perf_counter() - begin
+		if vote_buffer is not None:
+			vote_buffer.flush()
+	return latencies, elapsed, bot
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Replay recorded updates")
+	parser.add_argument("recordings", nargs = "+")
+	parser.add_argument("--speed", type = float, default = 1,
+			help = "Speed up factor, 0 for as fast as possible. Default 1")
+	parser.add_argument("--threads", type = int, default = 1,
+			help = "Number of updates handled concurrently")
+	parser.add_argument("--max-gap", type = float, default = 60,
+			help = "Cap the idle time between two updates, in seconds")
+	parser.add_argument("--seed-db",
+			help = "Start from a copy of this DB instead of an empty one")
+	parser.add_argument("--salt", help = "Salt of the recording, used to "
+			"anonymise the seed DB")
+	parser.add_argument("--bot-latency", type = float, default = 0,
+			help = "Simulated latency of a Bot API call, in seconds")
+	parser.add_argument("--max-chats", type = int, default = 1000,
+			help = "active_poll_store.max_chats")
+	parser.add_argument("--vote-buffer", action = "store_true",
+			help = "Enable the write-behind vote buffer")
+	parser.add_argument("-v", "--verbose", action = "store_true",
+			help = "Show the logs of the handlers")
+	args = parser.parse_args()
+
+	logger = logging.getLogger("app.log")
+	if not args.verbose:
+		for handler in logger.handlers:
+			handler.setLevel(logging.CRITICAL + 1)
+	error_counter = _ErrorCounter()
+	logger.addHandler(error_counter)
+	latencies, elapsed, bot = replay(args.recordings, speed = args.speed,
+			threads = args.threads, max_gap = args.max_gap,
+			seed_db = args.seed_db, salt = args.salt,
+			bot_latency = args.bot_latency, max_chats = args.max_chats,
+			is_vote_buffer = args.vote_buffer)
+	_report(latencies, elapsed, bot, error_counter.count)
@@ -1,42 +1,96 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import telepot
+import functools
+from app.base_app import BaseApp
 from app.config_loader import ConfigLoader
+from app.http_transport import configure_http_transport
 from app.log import Log
-from app.message_handler import CallbackQueryHandler, MessageHandler
-
-class StandaloneApp:
-	TELEGRAM_TOKEN = ConfigLoader.load("telegram_bot_token")
+from app.metrics import Metrics
+from app.message_handler import CallbackQueryHandler, InlineQueryHandler, \
+		MessageHandler
+from app.profiler import make_update_tag
 
+## Serves every bot in config.json, see ConfigLoader.load_bots(). Each bot long
+#  polls on its own thread, which merely waits on the network, and hands its
+#  updates over to the shared admission workers
+class StandaloneApp(BaseApp):
 	def __init__(self):
 		Log.i("Initializing standalone app")
-		self._bot = telepot.Bot(self.TELEGRAM_TOKEN)
+		workers = (ConfigLoader.load_optional("admission") or {}) \
+				.get("workers", 1)
+		configure_http_transport(ConfigLoader.load_optional("http"),
+				workers = workers, long_pollers = len(ConfigLoader.load_bots()))
 
 	def run(self):
 		import time
 		self._start()
 		Log.i("Running...")
+		log_interval = (ConfigLoader.load_optional("metrics") or {}) \
+				.get("log_interval", 0)
+		last_log_at = time.monotonic()
 		while True:
 			time.sleep(10)
+			if log_interval and time.monotonic() - last_log_at >= log_interval:
+				Log.i(Metrics.render())
+				last_log_at = time.monotonic()
+
+	def warm_up(self):
+		Log.i("Warming up")
+		try:
+			for tenant in self._tenants:
+				tenant.poll_store.warm_up()
+		except Exception as e:
+			# Not fatal, the first update will just be slower
+			Log.w("Failed while warm_up", e)
 
 	def _start(self):
 		Log.i("Starting app")
+		if self._vote_buffer is not None:
+			self._vote_buffer.recover()
+			self._vote_buffer.start()
+		self.warm_up()
+		self._scheduler.load()
+		self._scheduler.start()
+		if self._admission is not None:
+			self._admission.start()
+		for tenant in self._tenants:
+			self._start_tenant(tenant)
+
+	def _start_tenant(self, tenant):
 		def _listener(msg):
-			self._on_message(msg)
+			self._admit(tenant, "chat", msg, self._on_message)
 		def _callback_query_listener(msg):
-			self._on_callback_query(msg)
-		self._bot.setWebhook("")
-		self._bot.message_loop({
+			self._admit(tenant, "callback_query", msg, self._on_callback_query)
+		def _inline_query_listener(msg):
+			self._admit(tenant, "inline_query", msg, self._on_inline_query)
+		tenant.bot.setWebhook("")
+		tenant.bot.message_loop({
 			"chat": _listener,
 			"callback_query": _callback_query_listener,
+			"inline_query": _inline_query_listener,
 		})
 
-	def _on_message(self, msg):
-		MessageHandler(self._bot, msg, self._make_session_class()).handle()
+	def _admit(self, tenant, flavor, msg, handle):
+		if self._recorder is not None:
+			# Recorded in the shape of a webhook update, like on PAW
+			self._recorder.record({
+				"message" if flavor == "chat" else flavor: msg,
+			}, bot_id = tenant.bot_id)
+		if self._admission is None:
+			handle(tenant, msg)
+		else:
+			self._admission.submit(flavor, msg, lambda: handle(tenant, msg),
+					on_overload = functools.partial(self._on_overload, tenant))
+
+	def _on_message(self, tenant, msg):
+		with self._profiler.profile(make_update_tag("chat", msg)):
+			MessageHandler(tenant.bot, msg, tenant.poll_store,
+					bot_username = tenant.username).handle()
 
-	def _on_callback_query(self, msg):
-		CallbackQueryHandler(self._bot, msg, self._make_session_class()).handle()
+	def _on_callback_query(self, tenant, msg):
+		with self._profiler.profile(make_update_tag("callback_query", msg)):
+			CallbackQueryHandler(tenant.bot, msg, tenant.poll_store,
+					is_toast_response = self._is_toast_response).handle()
 
-	def _make_session_class(self):
-		sqlite_engine = create_engine("sqlite:///poll.db", echo = True)
-		return sessionmaker(bind = sqlite_engine)
+	def _on_inline_query(self, tenant, msg):
+		with self._profiler.profile(make_update_tag("inline_query", msg)):
+			InlineQueryHandler(tenant.bot, msg, tenant.poll_store,
+					cache_time = self._inline_query_cache_time).handle()
@@ -0,0 +1,23 @@
+import telepot
+from app.config_loader import ConfigLoader
+from app.poll_store import ActivePollStore
+
+## One of the bots served by the process, see ConfigLoader.load_bots(). Every bot
+#  has its own token and its own polls in the DB, while the engine, the HTTP
+#  pools, the admission workers, the vote buffer and the scheduler are shared
+class Tenant:
+	## Create the bots listed in config.json
+	@staticmethod
+	def load_all(Session, vote_buffer = None):
+		store_config = ConfigLoader.load_optional("active_poll_store")
+		return [Tenant(b["id"], telepot.Bot(b["telegram_bot_token"]),
+				ActivePollStore.from_config(Session, store_config,
+						vote_buffer = vote_buffer, bot_id = b["id"]),
+				username = b.get("username", "yapbbot"))
+				for b in ConfigLoader.load_bots()]
+
+	def __init__(self, bot_id, bot, poll_store, username = "yapbbot"):
+		self.bot_id = bot_id
+		self.bot = bot
+		self.poll_store = poll_store
+		self.username = username
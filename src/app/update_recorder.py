@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from app.log import Log
+
+## Replace the user and chat ids, and the names, in updates with stable pseudonyms
+#  derived from a secret salt. The same salt always maps an id to the same
+#  pseudonym, so a user voting twice is still the same user in the recording
+class Anonymiser:
+	def __init__(self, salt):
+		self._salt = salt.encode("utf-8")
+
+	def anonymise_id(self, id):
+		digest = hmac.new(self._salt, str(abs(id)).encode("ascii"),
+				hashlib.sha256).digest()
+		# 48 bits, well within what Telegram uses for ids. Group ids are negative
+		product = int.from_bytes(digest[:6], "big") or 1
+		return -product if id < 0 else product
+
+	def anonymise_name(self, id):
+		return "User%d" % (self.anonymise_id(id) % 100000)
+
+	def anonymise(self, obj):
+		"""Return a copy of @a obj, a deserialized update or a part of it, with
+		every user and chat anonymised
+		"""
+		if isinstance(obj, list):
+			return [self.anonymise(o) for o in obj]
+		if not isinstance(obj, dict):
+			return obj
+		product = {k: self.anonymise(v) for k, v in obj.items()}
+		if "id" in obj and "type" in obj and isinstance(obj["id"], int):
+			# Chat. Checked first, private chats have a first_name as well
+			product = {
+				"id": self.anonymise_id(obj["id"]),
+				"type": obj["type"],
+			}
+		elif "id" in obj and ("first_name" in obj or "is_bot" in obj):
+			# User
+			product = {
+				"id": self.anonymise_id(obj["id"]),
+				"is_bot": obj.get("is_bot", False),
+				"first_name": self.anonymise_name(obj["id"]),
+			}
+		return product
+
+## Append incoming updates to a gzip compressed JSON lines file, one update per
+#  line together with its arrival time and, when the process serves several
+#  bots, the id of the bot that received it, see read_recording()
+class UpdateRecorder:
+	## Create the recorder from the recording field in config.json, or return
+	#  None if recording is not enabled
+	@staticmethod
+	def from_config(config):
+		if not config:
+			return None
+		# Processes must not share a file, name it after the pid by default
+		path = config.get("path", "updates-{pid}.jsonl.gz") \
+				.format(pid = os.getpid())
+		return UpdateRecorder(path,
+				Anonymiser(config.get("salt") or os.urandom(16).hex()),
+				flush_interval = config.get("flush_interval", 10))
+
+	def __init__(self, path, anonymiser, flush_interval = 10):
+		self._anonymiser = anonymiser
+		self._flush_interval = flush_interval
+		# Appending starts a new gzip member, concatenated members are still a
+		# valid gzip file
+		self._file = gzip.open(path, "at", encoding = "utf-8")
+		self._flushed_at = time.monotonic()
+		self._lock = threading.Lock()
+		Log.i(f"Recording updates to {path}")
+
+	def record(self, update, bot_id = ""):
+		try:
+			record = {"t": round(time.time(), 3)}
+			if bot_id:
+				record["bot"] = bot_id
+			record["update"] = self._anonymiser.anonymise(update)
+			line = json.dumps(record, separators = (",", ":"))
+			with self._lock:
+				self._file.write(line + "\n")
+				now = time.monotonic()
+				# Flushing ends the current deflate block, don't do it too often
+				if now - self._flushed_at >= self._flush_interval:
+					self._file.flush()
+					self._flushed_at = now
+		except Exception as e:
+			# Never fail an update because of diagnostics
+			Log.e("Failed while recording update", e)
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+def read_recording(path):
+	"""Yield (arrival time, bot id, update) from a recording. A truncated tail,
+	e.g. from a worker that was killed, is ignored
+	"""
+	with gzip.open(path, "rt", encoding = "utf-8") as f:
+		try:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				yield record["t"], record.get("bot", ""), record["update"]
+		except EOFError:
+			pass
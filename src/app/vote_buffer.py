@@ -0,0 +1,246 @@
+import datetime
+import json
+import os
+import threading
+import time
+from app.log import Log
+import app.model as model
+
+## Write-behind buffer for votes. Votes and unvotes are appended to a local
+#  journal and acknowledged right away, then written to the poll_vote table in
+#  batches, one transaction per batch instead of one per click. Pending ops that
+#  are not in the DB yet are merged into the polls loaded by ActivePollStore with
+#  overlay()
+#
+#  The journal is the only copy of a pending op, so the buffer must be owned by
+#  a single process. recover() replays whatever was left behind by a crash
+class VoteBuffer:
+	## Create the buffer from the vote_buffer field in config.json, or return
+	#  None if write-behind is not enabled
+	@staticmethod
+	def from_config(Session, config):
+		if not config:
+			return None
+		return VoteBuffer(Session, config.get("journal", "vote_journal.log"),
+				max_batch = config.get("max_batch", 100),
+				max_delay = config.get("max_delay", 1.0),
+				is_fsync = config.get("fsync", True))
+
+	def __init__(self, Session, journal_path, max_batch = 100, max_delay = 1.0,
+			is_fsync = True):
+		self._Session = Session
+		self._journal_path = journal_path
+		self._max_batch = max_batch
+		self._max_delay = max_delay
+		self._is_fsync = is_fsync
+		# Pending ops in journal order, guarded by _lock
+		self._ops = []
+		self._first_op_at = None
+		self._journal = None
+		# Number of ops appended to the journal, and how many of them are known
+		# to be on disk
+		self._appended_count = 0
+		self._synced_count = 0
+		self._lock = threading.Lock()
+		# Only one fsync at a time, taken before _lock when both are needed
+		self._sync_lock = threading.Lock()
+		# Only one batch can be written at a time
+		self._flush_lock = threading.Lock()
+		self._flush_event = threading.Event()
+		self._thread = None
+
+	def recover(self):
+		"""Load the ops left in the journal by the last run and write them to the
+		DB. Must be called once before the buffer is used
+		"""
+		ops = []
+		if os.path.exists(self._journal_path):
+			with open(self._journal_path, "r") as f:
+				for line in f:
+					try:
+						ops += [json.loads(line)]
+					except ValueError:
+						# A torn write at the very end of the journal, the op was
+						# never acknowledged
+						Log.w(f"Dropping corrupted journal entry: {line}")
+		with self._lock:
+			self._ops = ops
+			self._first_op_at = time.monotonic() if ops else None
+			self._journal = open(self._journal_path, "a")
+		if ops:
+			Log.i(f"Replaying {len(ops)} journaled votes")
+			self.flush()
+
+	def start(self):
+		"""Flush from a background thread once the oldest pending op is older
+		than max_delay. Without it, flushes are only triggered by new ops and
+		flush_if_due()
+		"""
+		self._thread = threading.Thread(target = self._run, daemon = True)
+		self._thread.start()
+
+	def vote(self, poll_choice_id, user_id, user_name):
+		self._append({
+			"op": "vote",
+			"poll_choice_id": poll_choice_id,
+			"user_id": user_id,
+			"user_name": user_name,
+			"created_at": time.time(),
+		})
+
+	def unvote(self, poll_choice_id, user_id):
+		self._append({
+			"op": "unvote",
+			"poll_choice_id": poll_choice_id,
+			"user_id": user_id,
+		})
+
+	def rename(self, user_id, user_name):
+		self._append({
+			"op": "rename",
+			"user_id": user_id,
+			"user_name": user_name,
+		})
+
+	def get_pending_ops(self):
+		"""Return a copy of the ops not written to the DB yet, for overlay()"""
+		with self._lock:
+			return list(self._ops)
+
+	def overlay(self, poll, users, ops):
+		"""Apply @a ops, taken with get_pending_ops() before reading, to an
+		ActivePoll freshly loaded from the DB, with the voters taken from
+		@a users, a poll_store.UserCache
+		"""
+		for op in ops:
+			if op["op"] == "rename":
+				# Applied to the UserCache already
+				continue
+			choice = poll.find_choice(op["poll_choice_id"])
+			if choice is None:
+				continue
+			# An op may have been committed already while the poll was loading,
+			# applying it again is harmless
+			if op["op"] == "vote":
+				choice.voters.setdefault(op["user_id"],
+						users.get(op["user_id"], op["user_name"]))
+			else:
+				choice.voters.pop(op["user_id"], None)
+
+	def flush_if_due(self):
+		with self._lock:
+			is_due = self._is_due()
+		if is_due:
+			self.flush()
+
+	def flush(self):
+		"""Write all pending ops to the DB in a single transaction"""
+		with self._flush_lock:
+			with self._lock:
+				count = len(self._ops)
+				batch = self._ops[:count]
+			if not batch:
+				return
+			self._write_batch(batch)
+			with self._sync_lock, self._lock:
+				del self._ops[:count]
+				self._first_op_at = time.monotonic() if self._ops else None
+				self._rewrite_journal()
+				# The new journal is on disk as a whole
+				self._synced_count = self._appended_count
+		Log.d(f"Flushed {count} votes")
+
+	def _append(self, op):
+		with self._lock:
+			self._journal.write(json.dumps(op) + "\n")
+			self._journal.flush()
+			self._appended_count += 1
+			seq = self._appended_count
+			self._ops += [op]
+			if self._first_op_at is None:
+				self._first_op_at = time.monotonic()
+			is_due = self._is_due()
+		if self._is_fsync:
+			# Only acknowledged once it's on disk
+			self._sync(seq)
+		if is_due:
+			if self._thread is not None:
+				self._flush_event.set()
+			else:
+				self._try_flush()
+
+	def _sync(self, seq):
+		"""Group commit, one fsync covers every op appended so far, including
+		those of the threads that were waiting for it
+		"""
+		with self._sync_lock:
+			if self._synced_count >= seq:
+				return
+			with self._lock:
+				count = self._appended_count
+				fd = self._journal.fileno()
+			# Appends carry on meanwhile
+			os.fsync(fd)
+			self._synced_count = count
+
+	def _is_due(self):
+		if not self._ops:
+			return False
+		return len(self._ops) >= self._max_batch \
+				or time.monotonic() - self._first_op_at >= self._max_delay
+
+	def _write_batch(self, batch):
+		# Only the last op of each (choice, user) pair matters
+		final_ops = {}
+		for op in batch:
+			if op["op"] != "rename":
+				final_ops[(op["poll_choice_id"], op["user_id"])] = op
+		# Likewise for the names, each user is written once per batch
+		user_names = {op["user_id"]: op["user_name"] for op in batch
+				if op["op"] in ("vote", "rename")}
+		with model.open_session(self._Session) as s:
+			for user_id, name in user_names.items():
+				model.upsert_user(s, user_id, name)
+			# Unvotes first, so that they don't hold up a vote for another
+			# choice of a single vote poll
+			for (poll_choice_id, user_id), op in final_ops.items():
+				if op["op"] == "unvote":
+					s.query(model.PollVote) \
+							.filter(model.PollVote.poll_choice_id == poll_choice_id) \
+							.filter(model.PollVote.user_id == user_id) \
+							.delete(synchronize_session = False)
+			for (poll_choice_id, user_id), op in final_ops.items():
+				if op["op"] == "vote":
+					# Checked by the DB as well, in case it was accepted against
+					# a stale snapshot. The choice may also have been removed
+					# since the vote
+					model.insert_vote(s, poll_choice_id, user_id,
+							datetime.datetime.utcfromtimestamp(op["created_at"]))
+
+	def _rewrite_journal(self):
+		tmp_path = self._journal_path + ".tmp"
+		with open(tmp_path, "w") as f:
+			for op in self._ops:
+				f.write(json.dumps(op) + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+		self._journal.close()
+		os.replace(tmp_path, self._journal_path)
+		self._journal = open(self._journal_path, "a")
+
+	def _run(self):
+		while True:
+			self._flush_event.wait(self._max_delay)
+			self._flush_event.clear()
+			with self._lock:
+				is_due = self._is_due()
+			if is_due:
+				self._try_flush()
+
+	def _try_flush(self):
+		try:
+			self.flush()
+		except Exception as e:
+			# The op is in the journal already, it'll be retried by the next
+			# flush
+			Log.e("Failed while flush", e)